@@ -0,0 +1,139 @@
+'''
+Benchmarks for unpacking and packing the formats shipped with abstruct.
+
+For each format and input the operations are timed taking the best of some
+repetitions, the peak of the memory allocated is measured with tracemalloc
+in a separate run (tracing slows down everything). Run it with
+
+    $ python -m abstruct.benchmarks --help
+'''
+import logging
+import time
+import tracemalloc
+from typing import Callable, Iterable, List, NamedTuple, Optional, Tuple
+
+from ..streams import Stream
+from . import inputs
+
+
+logger = logging.getLogger(__name__)
+
+
+class Case(NamedTuple):
+    '''An input to benchmark for a given format.'''
+    format: str
+    cls: type
+    label: str
+    data: bytes
+
+
+class Result(NamedTuple):
+    format: str
+    label: str
+    operation: str
+    size: int           # bytes of the input
+    seconds: Optional[float]  # best time for a single operation
+    peak: Optional[int]  # bytes allocated at most during a single operation
+    error: Optional[str] = None
+
+    @property
+    def throughput(self) -> Optional[float]:
+        '''MB/s'''
+        return self.size / self.seconds / (1 << 20) if self.seconds else None
+
+    @property
+    def rate(self) -> Optional[float]:
+        '''objects/s'''
+        return 1 / self.seconds if self.seconds else None
+
+
+def get_cases(elf_paths: Iterable[str] = (), scale: int = 0) -> List[Case]:
+    '''The inputs for each format, with scale greater than zero there are
+    also synthetic ones (see inputs).'''
+    from ..executables.elf import ElfFile
+    from ..images.png import PNGFile
+    from ..compression.zip import ZIPLocalFileHeader, ZIPEndOfCentralDirectory
+    from ..communications.stk500 import STK500Packet
+
+    formats = [
+        ('elf', ElfFile, inputs.elf_inputs(list(elf_paths), scale=scale)),
+        ('png', PNGFile, inputs.png_inputs(scale=scale)),
+        ('zip-local-file-header', ZIPLocalFileHeader, inputs.zip_local_file_header_inputs()),
+        ('zip-end-of-central-directory', ZIPEndOfCentralDirectory, inputs.zip_end_of_central_directory_inputs()),
+        ('stk500', STK500Packet, inputs.stk500_inputs()),
+    ]
+
+    return [Case(name, cls, label, data) for name, cls, _inputs in formats for label, data in _inputs]
+
+
+def _unpack(case: Case) -> Callable:
+    return lambda: case.cls(Stream(case.data))
+
+
+def _pack(case: Case) -> Callable:
+    obj = case.cls(Stream(case.data))
+
+    return obj.pack
+
+
+def _roundtrip(case: Case) -> Callable:
+    return lambda: case.cls(Stream(case.data)).pack()
+
+
+OPERATIONS = {
+    'unpack': _unpack,
+    'pack': _pack,
+    'roundtrip': _roundtrip,
+}
+
+
+def measure(function: Callable, repeat: int) -> Tuple[float, int]:
+    '''Return the best time of function over repeat runs and the peak of
+    memory allocated by a single run.'''
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def run(cases: Iterable[Case], operations: Iterable[str] = OPERATIONS, repeat: int = 5) -> Iterable[Result]:
+    '''Yield a Result for each case and operation; an operation that fails
+    (not every format can be packed) is reported with its error.'''
+    for case in cases:
+        for operation in operations:
+            try:
+                seconds, peak = measure(OPERATIONS[operation](case), repeat)
+            except Exception as e:
+                logger.debug('%s %s failed on %s', case.format, operation, case.label, exc_info=True)
+                yield Result(case.format, case.label, operation, len(case.data), None, None, error=repr(e))
+                continue
+
+            yield Result(case.format, case.label, operation, len(case.data), seconds, peak)
+
+
+def format_result(result: Result) -> str:
+    prefix = f'{result.format:30s} {result.label:14s} {result.operation:10s} {result.size:10d}'
+
+    if result.error is not None:
+        return f'{prefix}  failed: {result.error}'
+
+    return (
+        f'{prefix} {result.seconds * 1000:12.3f} {result.throughput:10.2f} '
+        f'{result.rate:12.1f} {result.peak / (1 << 20):10.2f}'
+    )
+
+
+HEADER = f'{"format":30s} {"input":14s} {"operation":10s} {"bytes":>10s} {"ms":>12s} {"MB/s":>10s} {"objects/s":>12s} {"peak MB":>10s}'
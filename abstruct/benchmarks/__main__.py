@@ -0,0 +1,36 @@
+import argparse
+import logging
+import os
+
+from . import HEADER, OPERATIONS, format_result, get_cases, run
+
+
+logging.basicConfig(level=logging.DEBUG if 'DEBUG' in os.environ else logging.ERROR)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m abstruct.benchmarks', description='benchmark the formats of abstruct')
+
+    parser.add_argument('--repeat', type=int, default=5, help='number of runs for each measure, the best is taken')
+    parser.add_argument('--format', action='append', dest='formats', help='benchmark only this format (can be repeated)')
+    parser.add_argument('--operation', action='append', dest='operations', choices=list(OPERATIONS),
+                        help='benchmark only this operation (can be repeated)')
+    parser.add_argument('--elf', action='append', default=[], help='an additional ELF file to use as input')
+    parser.add_argument('--scale', type=int, default=0,
+                        help='add synthetic inputs growing with this value (100 gives ELF with 100k symbols)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    cases = get_cases(elf_paths=args.elf, scale=args.scale)
+
+    if args.formats:
+        cases = [_ for _ in cases if _.format in args.formats]
+
+    print(HEADER)
+
+    for result in run(cases, operations=args.operations or list(OPERATIONS), repeat=args.repeat):
+        print(format_result(result), flush=True)
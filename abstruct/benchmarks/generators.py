@@ -0,0 +1,193 @@
+'''
+Synthetic inputs of arbitrary size built with the pack path of the library:
+the objects are created field by field and then packed, so that the same
+parameters always give the same bytes and the generation itself exercises
+the code that writes the formats.
+'''
+import struct
+import zlib
+from random import Random
+
+from .. import fields
+from ..compression.zip import (
+    ZIPCentralDirectoryHeader,
+    ZIPCompressionMethod,
+    ZIPEndOfCentralDirectory,
+    ZIPLocalFileHeader,
+)
+from ..executables.elf import ElfFile, SectionHeader
+from ..executables.elf.enum import ElfSectionType, ElfSectionFlag, ElfSymbolBindType, ElfSymbolType, ElfType
+from ..executables.elf.fields import SectionStringTable, SymbolTable
+from ..images.png import PNGColorType, PNGFile
+
+
+def _string_offsets(strings):
+    '''The index of each string in the table containing them.'''
+    offsets, offset = [], 0
+    for string in strings:
+        offsets.append(offset)
+        offset += len(string.encode()) + 1
+
+    return offsets
+
+
+def _section(elf, sh_name, sh_type, **values):
+    header = SectionHeader(father=elf.sections_header)
+    header.sh_name.value = sh_name
+    header.sh_type.value = sh_type
+
+    for name, value in values.items():
+        getattr(header, name).value = value
+
+    return header
+
+
+def generate_elf(n_symbols: int = 1000, n_sections: int = 10) -> bytes:
+    '''An ELF relocatable with n_sections sections of code (plus the ones
+    needed for the names and the symbols) and a symbol table with n_symbols
+    entries, each one pointing to one of the sections.'''
+    elf = ElfFile()
+    elf.header.e_type.value = ElfType.ET_REL
+
+    code_names = [f'.text.{idx}' for idx in range(n_sections)]
+    symbol_names = [f'symbol_{idx}' for idx in range(n_symbols)]
+
+    # the NULL section, the tables and then the code
+    shstrtab = SectionStringTable(father=elf.sections)
+    shstrtab.value = ['', '.shstrtab', '.strtab', '.symtab'] + code_names
+    strtab = SectionStringTable(father=elf.sections)
+    strtab.value = [''] + symbol_names
+
+    section_indexes = dict(zip(shstrtab.value, _string_offsets(shstrtab.value)))
+    symbol_indexes = _string_offsets(strtab.value)
+
+    symtab = SymbolTable(father=elf.sections)
+    # the first entry of the symbol table is always the undefined symbol
+    for idx in range(n_symbols + 1):
+        entry = symtab.instance_element()
+        if idx:
+            entry.st_name.value = symbol_indexes[idx]
+            entry.st_value.value = (idx - 1) // max(n_sections, 1) * 4
+            entry.st_size.value = 4
+            entry.st_info.value = (ElfSymbolBindType.STB_GLOBAL.value << 4) | ElfSymbolType.STT_FUNC.value
+            entry.st_shndx.value = 4 + (idx - 1) % n_sections if n_sections else 0
+        symtab.append(entry)
+
+    symbols_per_section = -(-n_symbols // n_sections) if n_sections else 0
+    codes = []
+    for idx in range(n_sections):
+        code = b'\x90\x90\x90\xc3' * symbols_per_section
+        codes.append(code)
+
+    entry_size = symtab.instance_element().size()
+    headers = [
+        _section(elf, 0, ElfSectionType.SHT_NULL),
+        _section(elf, section_indexes['.shstrtab'], ElfSectionType.SHT_STRTAB, sh_addralign=1),
+        _section(elf, section_indexes['.strtab'], ElfSectionType.SHT_STRTAB, sh_addralign=1),
+        _section(elf, section_indexes['.symtab'], ElfSectionType.SHT_SYMTAB,
+                 sh_link=2, sh_info=1, sh_addralign=4, sh_entsize=entry_size),
+    ]
+    sections = [fields.StringField(0), shstrtab, strtab, symtab]
+
+    for name, code in zip(code_names, codes):
+        headers.append(_section(elf, section_indexes[name], ElfSectionType.SHT_PROGBITS,
+                                sh_flags=ElfSectionFlag.SHF_ALLOC | ElfSectionFlag.SHF_EXECINSTR, sh_addralign=16))
+        section = fields.StringField(len(code), father=elf.sections)
+        section.value = code
+        sections.append(section)
+
+    elf.sections_header.value = headers
+    elf.sections.value = sections
+
+    elf.header.e_shnum.value = len(headers)
+    elf.header.e_shstrndx.value = 1
+
+    return elf.pack()
+
+
+def _png_chunk(png, type, data):
+    chunk = png.chunks.instance_element()
+    chunk.type.value = type
+    chunk.length.value = len(data)
+    chunk.Data.value = data
+
+    return chunk
+
+
+def generate_png(width: int = 256, height: int = 256, idat_size: int = 8192) -> bytes:
+    '''An RGB image with pseudo-random pixels (so that they don't compress)
+    whose data is split in IDAT chunks of idat_size bytes.'''
+    rng = Random(0)
+    # each scanline starts with the filter type, here always NONE
+    scanlines = b''.join([b'\x00' + rng.getrandbits(8 * width * 3).to_bytes(width * 3, 'little') for _ in range(height)])
+    data = zlib.compress(scanlines)
+
+    png = PNGFile()
+
+    ihdr = png.chunks.instance_element()
+    ihdr.type.value = b'IHDR'
+    header = ihdr.Data.get_field()
+    header.width.value = width
+    header.height.value = height
+    header.depth.value = 8
+    header.color.value = PNGColorType.RGB
+    ihdr.length.value = header.size()
+
+    chunks = [ihdr]
+    chunks += [_png_chunk(png, b'IDAT', data[_:_ + idat_size]) for _ in range(0, len(data), idat_size)]
+    chunks.append(_png_chunk(png, b'IEND', b''))
+
+    for chunk in chunks:
+        png.chunks.append(chunk)
+
+    return png.pack()
+
+
+def generate_zip(n_members: int = 1000, member_size: int = 64) -> bytes:
+    '''An archive of n_members stored (i.e. not compressed) files of
+    member_size bytes. The number of entries in the end of central
+    directory is capped at 0xffff, like the archivers do when they don't
+    use the ZIP64 extension, the readers use the size of the directory.'''
+    # each chunk is packed by itself and the parts joined at the end, packing
+    # all of them in the same stream would copy it for each member
+    members = []
+    directory = []
+    offset = 0
+
+    for idx in range(n_members):
+        filename = f'member/{idx:08d}'.encode()
+        data = struct.pack('<I', idx) * (member_size // 4) + b'\x00' * (member_size % 4)
+        crc = zlib.crc32(data)
+
+        local = ZIPLocalFileHeader()
+        local.version.value = 20
+        local.compression.value = ZIPCompressionMethod.NONE
+        local.crc32.value = crc
+        local.compressed_size.value = len(data)
+        local.uncompressed_size.value = len(data)
+        local.filename_length.value = len(filename)
+        local.filename.value = filename
+
+        members += [local.pack(), data]
+
+        central = ZIPCentralDirectoryHeader()
+        central.version_by.value = 20
+        central.version_needed.value = 20
+        central.crc_32.value = crc
+        central.compressed_size.value = len(data)
+        central.uncompressed_size.value = len(data)
+        central.filename_length.value = len(filename)
+        central.relative_offset.value = offset
+        central.filename.value = filename
+
+        directory.append(central.pack())
+
+        offset += len(members[-2]) + len(data)
+
+    end = ZIPEndOfCentralDirectory()
+    end.n_entry.value = min(n_members, 0xffff)
+    end.central_dir.value = min(n_members, 0xffff)
+    end.size_central_dir.value = sum([len(_) for _ in directory])
+    end.off.value = offset
+
+    return b''.join(members + directory + [end.pack()])
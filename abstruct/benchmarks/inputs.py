@@ -0,0 +1,106 @@
+'''
+The inputs for the benchmarks: each function returns a list of couples
+(label, data) of increasing size for a given format.
+
+With a scale greater than zero there are also synthetic inputs built by the
+generators, their size grows linearly with it (scale 100 gives an ELF with
+100k symbols).
+'''
+import io
+import os
+import random
+import struct
+from typing import List, Tuple
+
+from . import generators
+
+
+PATH_BASE = os.path.join(os.path.dirname(__file__), '..')
+
+
+def _read(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def elf_inputs(paths: List[str] = (), scale: int = 0) -> List[Tuple[str, bytes]]:
+    '''The ELF executable used by the tests plus any other passed as argument.'''
+    paths = [os.path.join(PATH_BASE, 'main')] + list(paths)
+    inputs = [(os.path.basename(_), _read(_)) for _ in paths]
+
+    if scale:
+        inputs.append((f'synthetic-x{scale}', generators.generate_elf(n_symbols=1000 * scale, n_sections=10 * scale)))
+
+    return inputs
+
+
+def png_inputs(sides=(16, 256, 1024), scale: int = 0) -> List[Tuple[str, bytes]]:
+    '''Square images with random pixels (so that the data doesn't compress),
+    if pillow is not available only the image used by the tests.'''
+    inputs = [('red.png', _read(os.path.join(PATH_BASE, 'red.png')))]
+
+    if scale:
+        # a lot of small IDAT chunks
+        inputs.append((f'synthetic-x{scale}', generators.generate_png(width=256, height=64 * scale, idat_size=1024)))
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return inputs
+
+    rng = random.Random(0)
+
+    for side in sides:
+        image = Image.frombytes('RGB', (side, side), bytes([rng.getrandbits(8) for _ in range(side * side * 3)]))
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+
+        inputs.append((f'{side}x{side}', output.getvalue()))
+
+    return inputs
+
+
+def zip_local_file_header_inputs(sizes=(0, 1024, 60 * 1024)) -> List[Tuple[str, bytes]]:
+    '''Local file headers with an extra field of the given sizes.'''
+    inputs = []
+
+    for size in sizes:
+        filename = b'a/b'
+        data = b'PK\x03\x04' + struct.pack(
+            '<HHHHHIIIHH',
+            20,  # version
+            0,   # flags
+            0,   # compression
+            0,   # modification time
+            0,   # modification date
+            0,   # crc32
+            0,   # compressed size
+            0,   # uncompressed size
+            len(filename),
+            size,
+        ) + filename + b'\xaa' * size
+
+        inputs.append((f'extra={size}', data))
+
+    return inputs
+
+
+def zip_end_of_central_directory_inputs(sizes=(0, 1024, 60 * 1024)) -> List[Tuple[str, bytes]]:
+    '''End of central directory records with a comment of the given sizes.'''
+    return [
+        (f'comment={size}', b'PK\x05\x06' + struct.pack('<HHHHIIH', 0, 0, 1, 1, 0x2e, 0x3f, size) + b'c' * size)
+        for size in sizes
+    ]
+
+
+def stk500_inputs(sizes=(16, 1024, 0xffff)) -> List[Tuple[str, bytes]]:
+    '''Packets with a body of the given sizes.'''
+    inputs = []
+
+    for size in sizes:
+        body = bytes([_ & 0xff for _ in range(size)])
+        data = struct.pack('>BBHB', 0x1b, 0x01, size, 0x0e) + body + b'\x00'
+
+        inputs.append((f'body={size}', data))
+
+    return inputs
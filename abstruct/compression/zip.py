@@ -91,11 +91,12 @@ class ZIPCentralDirectoryHeader(Chunk):
     last_modification_time   = fields.StructField('H')
     last_modification_date   = fields.StructField('H')
     crc_32                   = fields.StructField('I')  # TODO: use CRC field
-    compressed_size          = fields.StructField('H')
-    uncompressed_size        = fields.StructField('H')
+    compressed_size          = fields.StructField('I')
+    uncompressed_size        = fields.StructField('I')
     filename_length          = fields.StructField('H')
     extra_length             = fields.StructField('H')
     comment_length           = fields.StructField('H')
+    disk_number_start        = fields.StructField('H')
     internal_file_attributes = fields.StructField('H')
     external_file_attributes = fields.StructField('I')
     relative_offset          = fields.StructField('I')
@@ -1,9 +1,12 @@
+import io
 import logging
+import time
+from contextlib import nullcontext
 from typing import Tuple, List, Dict
 
-from .fields import Field
+from .fields import Field, stream_offsets, untracked
 from .enum import Compliant
-from .streams import Stream
+from .streams import BufferIO, Stream
 from .exceptions import (
     ChunkUnpackException,
     UnpackException,
@@ -13,12 +16,63 @@ from .properties import (
     get_root_from_chunk,
     Dependency,
 )
+from .plan import ChunkPlan
+from . import profiling
+
+
+def _chain_exception(e, field_name):
+    chain = e.chain if isinstance(e, ChunkUnpackException) else []
+    chain.append(field_name)
+
+    return ChunkUnpackException(chain=chain)
+
+
+def _is_tracked(field, root, dirty) -> bool:
+    '''Return True if the modified field is still in the tree of root (it could
+    have been replaced) and none of its ancestors is rewritten as a whole.'''
+    while field is not root:
+        father = field.__dict__['father']
+
+        if father is None or id(father) in dirty:
+            return False
+
+        if isinstance(father, Chunk):
+            if field.name in father._meta.fields and father.__dict__.get(field.name) is not field:
+                return False
+        else:
+            value = father.__dict__.get('_value')
+            if isinstance(value, list) and not any(_ is field for _ in value):
+                return False
+
+        field = father
+
+    return True
+
+
+class PendingFields(object):
+    '''Bookkeeping for a Chunk unpacked lazily: the fields not yet decoded,
+    where the chunk starts and where each of the decoded fields ends.'''
+
+    def __init__(self, stream, offset, names):
+        self.stream = stream
+        self.offset = offset
+        self.names = names
+        self.pending = set(names)
+        self.ends = {}
+        self.active = 0  # how many materialize() are in progress
+
+    def __contains__(self, name):
+        return name in self.pending
+
+    def __len__(self):
+        return len(self.pending)
 
 
 class Meta(object):
 
     def __init__(self):
         self.fields = []
+        self.plans = {}  # the compiled ChunkPlan for each order of the fields
 
 
 class MetaChunk(type):
@@ -54,7 +108,7 @@ class MetaChunk(type):
 
     def add_to_class(cls, name, value):
         if hasattr(value, 'contribute_to_chunk'):
-            cls.logger.debug('contribute_to_chunk() found for field \'%s\'' % name)
+            cls.logger.debug('contribute_to_chunk() found for field \'%s\'', name)
             cls._meta.fields.append(name)
             value.contribute_to_chunk(cls, name)
         else:
@@ -85,15 +139,24 @@ class Chunk(Field, metaclass=MetaChunk):
     the fields won't be found.
     '''
 
-    def __init__(self, filepath=None, **kwargs):
-        self.stream = Stream(filepath) if filepath is not None else filepath
+    caches_size = True
+    # repack() can rewrite the whole chunk when a field changed size, i.e. the
+    # layout computed by pack() is the one of the stream
+    resizable = True
+
+    def __init__(self, filepath=None, lazy=False, **kwargs):
+        '''If lazy is True only the position of the fields is recorded and each
+        one of them is decoded the first time is accessed.
+
+        filepath can be anything a Stream accepts or a Stream itself.'''
+        self.stream = filepath if filepath is None or isinstance(filepath, Stream) else Stream(filepath)
         super().__init__(**kwargs)
 
         # now we have setup all the fields necessary and we can unpack if
         # some data is passed with the constructor
         if self.stream:
-            self.logger.debug('unpacking \'%s\' from %s' % (self.__class__.__name__, self.stream))
-            self.unpack(self.stream)
+            self.logger.debug('unpacking \'%s\' from %s', self.__class__.__name__, self.stream)
+            self.unpack(self.stream, lazy=lazy)
         else:
             for name in self.__class__._meta.fields:
                 getattr(self, name).init()  # FIXME: understand init() logic :P
@@ -105,6 +168,10 @@ class Chunk(Field, metaclass=MetaChunk):
         '''It returns a list of couples (name, instance) for each field.'''
         return [(_, getattr(self, _)) for _ in self.get_ordered_fields_name()]
 
+    def get_plan(self, fields: List[Tuple[str, Field]]) -> ChunkPlan:
+        '''Return the compiled plan for this chunk given its fields.'''
+        return ChunkPlan.for_chunk(self, fields)
+
     def get_dependencies(self) -> Dict[str, Dependency]:
         dep = super().get_dependencies()
 
@@ -140,13 +207,18 @@ class Chunk(Field, metaclass=MetaChunk):
         return self.root == self
 
     def size(self):
-        '''the size parameter MUST not be set but MUST be derived from the subchunks'''
+        '''the size parameter MUST not be set but MUST be derived from the subchunks,
+        it's cached until one of them changes'''
+        size = self.get_cached_size()
+        if size is not None:
+            return size
+
         size = 0
         for field_name in self._meta.fields:
             field = getattr(self, field_name)
             size += field.size()
 
-        return size
+        return self.set_cached_size(size)
 
     @property
     def raw(self):
@@ -161,14 +233,18 @@ class Chunk(Field, metaclass=MetaChunk):
         and the phase in order to pack correctly.
 
         In practice it's like packing() but it's only interested in the sizes
-        of the chunks.'''
+        of the chunks. Like for the fields, it returns the size.'''
         self.offset = offset
-        for field_name, field_instance in self.get_fields():
-            self.logger.debug('relayouting %s.%s' % (self.__class__.__name__, field_name))
+        start = offset
 
-            offset += field_instance.relayout(offset=offset)
+        # the values updated to place the fields are not modifications
+        with untracked:
+            for field_name, field_instance in self.get_fields():
+                self.logger.debug('relayouting %s.%s', self.__class__.__name__, field_name)
 
-        return offset
+                offset += field_instance.relayout(offset=offset)
+
+        return offset - start
 
     def pack(self, stream=None, relayout=True):
         '''
@@ -179,29 +255,156 @@ class Chunk(Field, metaclass=MetaChunk):
 
         **we need to update size and offset during the packing phase**
         '''
+        with untracked:  # the values computed while packing are not modifications
+            return self._pack(stream, relayout)
+
+    def _pack(self, stream, relayout):
         # if we are the root father then we can set our offset to zero
         # and initialize the stream
-        if relayout:
-            self.relayout()
+        size = self.relayout() if relayout else None
+        own = not stream
 
-        stream = Stream(b'') if not stream else stream
+        if own:
+            # relayout() gives the size, the data is packed in a buffer allocated once
+            stream = Stream(BufferIO(bytearray(size if size is not None else self.size())))
 
-        for field_name, field_instance in self.get_fields():
-            self.logger.debug('packing %s.%s' % (self.__class__.__name__, field_name))
+        fields = self.get_fields()
+        runs = self.get_plan(fields).pack_runs
+
+        idx = 0
+        while idx < len(fields):
+            run = runs.get(idx)
+            if run is not None and self.pack_run(run, fields[idx:idx + len(run)], stream):
+                idx += len(run)
+                continue
 
+            field_name, field_instance = fields[idx]
+            idx += 1
+
+            self.logger.debug('packing %s.%s', self.__class__.__name__, field_name)
 
             if field_instance.offset is None:
                 raise AttributeError(f'offset for field named "{field_name}" {field_instance!r} is not defined!')
 
             stream.seek(field_instance.offset)
 
-            self.logger.debug('field %s set at offset %08x' % (field_name, field_instance.offset))
+            self.logger.debug('field %s set at offset %08x', field_name, field_instance.offset)
             # we call pack() on the subchunks
-            field_instance.pack(stream=stream, relayout=False)  # we hope someone triggered the relayout before
+            if profiling.hooks:
+                with profiling.measure('pack', field_instance, stream):
+                    field_instance.pack(stream=stream, relayout=False)
+            else:
+                field_instance.pack(stream=stream, relayout=False)  # we hope someone triggered the relayout before
+
+        # the buffer is copied only here, the nested fields return nothing
+        return stream.getvalue() if own else None
+
+    def repack(self, stream=None) -> List[Tuple[int, int]]:
+        '''Write into stream (by default the one the chunk was unpacked from, it
+        must be writable like Stream(path, flags='r+')) only the fields modified
+        after unpack(), so that patching a value of a big file writes just its
+        bytes. This is possible only if none of them changed size, otherwise
+        the whole chunk is packed at its offset and the stream truncated where
+        it ends: if something follows the chunk in the stream (or it was
+        unpacked lazily, or it's not resizable) a ValueError is raised instead.
+
+        The fields are written where they were unpacked from, even if pack()
+        placed them somewhere else in the meantime.
+
+        It returns the ranges (offset, size) written.'''
+        dirty = self.__dict__.get('_dirty')
 
-        return stream.obj.getvalue()
+        if dirty is None:
+            raise ValueError('only the root of a tree unpacked from a stream can be repacked')
 
-    def unpack(self, stream):
+        stream = self.stream if stream is None else stream
+        entries = [_ for _ in dirty.values() if _is_tracked(_[0], self, dirty)]
+
+        if any(offset is None or field.size() != size for field, offset, size in entries):
+            self.logger.debug('the layout of %s changed, packing it all', self.__class__.__name__)
+            start = self.__dict__['_stream_offset']
+            end = self.__dict__.get('_end')
+
+            if not self.resizable:
+                raise ValueError(f'{self.__class__.__name__} changed size and its layout cannot change')
+
+            if end is None or end != stream.obj.seek(0, io.SEEK_END):
+                raise ValueError(
+                    f'{self.__class__.__name__} changed size and it\'s not at the end of the stream, '
+                    'it cannot be repacked in place')
+
+            # packed apart since the stream must be truncated where the data ends
+            data = self.pack()
+
+            # now the fields are in the stream where the layout puts them
+            with untracked, stream_offsets:
+                self.relayout(offset=start)
+
+            stream.seek(start)
+            stream.write(data)
+            stream.obj.truncate(start + len(data))
+
+            self.__dict__['_end'] = start + len(data)
+            dirty.clear()
+
+            return [(start, len(data))]
+
+        ranges = []
+        fathers = {}
+
+        with untracked:
+            for field, offset, size in entries:
+                field.relayout(offset=offset)
+                stream.seek(offset)
+                field.pack(stream=stream, relayout=False)
+
+                ranges.append((offset, size))
+                fathers[id(field.father)] = field.father
+
+            # the fields computed from the others (like a CRC) must follow them
+            for father in fathers.values():
+                if not isinstance(father, Chunk):
+                    continue
+
+                for _, field in father.get_fields():
+                    if type(field)._update_value is not Field._update_value and id(field) not in dirty:
+                        offset = field.__dict__['_stream_offset']
+                        field.relayout(offset=offset)
+                        stream.seek(offset)
+                        field.pack(stream=stream, relayout=False)
+
+                        ranges.append((offset, field.size()))
+
+        dirty.clear()
+
+        return sorted(ranges)
+
+    def pack_into(self, buffer, offset=0) -> int:
+        '''Pack the chunk into buffer (a bytearray or a writable memoryview) starting
+        at offset, the same buffer can be reused to pack many chunks without
+        allocating anything for the data. It returns the number of bytes packed.'''
+        size = self.relayout(offset=offset)
+        self.pack(stream=Stream(BufferIO(buffer)), relayout=False)
+
+        return size
+
+    def pack_to(self, sink) -> int:
+        '''Pack the chunk directly into sink, a path (that is overwritten) or a
+        writable file object: each field is written at its offset without
+        building the data in memory. It returns the size of the sink after
+        packing (the sections of a format can end after the last field).'''
+        stream = sink if isinstance(sink, Stream) else Stream(sink, flags='w')
+
+        try:
+            self.pack(stream=stream)
+            size = stream.obj.seek(0, io.SEEK_END)
+        finally:
+            if isinstance(sink, str):
+                stream.close()
+
+        return size
+
+    def unpack(self, stream, lazy=False):
         '''This is one of the main APIs to take care of: its aim is to take a binary
         data and transform in the representation given by the class this method
         is implemented.
@@ -217,30 +420,266 @@ class Chunk(Field, metaclass=MetaChunk):
 
             1. you can have size and offset dependencies
             2. you can enforce dependencies or not
+
+        With lazy set to True nothing is decoded right now: the fields are
+        unpacked on first access (see materialize()), only the ones needed to
+        find where the accessed field starts are unpacked with it.
+
+        From now on the modifications of the root chunk's tree are tracked (see repack()).
         '''
-        for field_name, field in self.get_fields():
-            self.logger.debug('unpacking %s.%s' % (self.__class__.__name__, field_name))
+        start = stream.tell()
+
+        with untracked, stream_offsets:
+            self._unpack(stream, lazy)
+
+        if self.__dict__['father'] is None:
+            self.__dict__['_stream_offset'] = start
+            self.__dict__['_dirty'] = {}
+            # where the data ends, repack() can resize the chunk only if nothing follows it
+            self.__dict__['_end'] = None if lazy else self._get_end()
+
+    def _get_end(self):
+        '''Return the offset where the data of the fields ends (the farthest one,
+        they are not necessarily in order).'''
+        return max([field.offset + field.size() for _, field in self.get_fields()], default=self.offset or 0)
+
+    def _unpack(self, stream, lazy):
+        fields = self.get_fields()
+
+        if lazy:
+            self.__dict__['_pending'] = PendingFields(stream, stream.tell(), [_ for _, __ in fields])
+            return
+        runs = self.get_plan(fields).unpack_runs
+
+        idx = 0
+        while idx < len(fields):
+            run = runs.get(idx)
+            if run is not None and self.unpack_run(run, fields[idx:idx + len(run)], stream):
+                idx += len(run)
+                continue
+
+            field_name, field = fields[idx]
+            self.unpack_field(field_name, field, stream)
+            idx += 1
+
+        self.unpack_validate()
+
+    def unpack_validate(self):
+        if hasattr(self, 'validate'):
+            ret = self.validate()
+            if not ret:
+                self.logger.warning(f'magic for field \'{self.name}\' failed')
+                if self.compliant & Compliant.MAGIC:
+                    raise MagicException(chain=[])
+
+    def unpack_field(self, field_name, field, stream, lazy=False):
+        '''Unpack a single field, with lazy set to True the field must be a Chunk
+        and it's unpacked lazily.'''
+        if profiling.hooks:
+            with profiling.measure('unpack', field, stream):
+                self._unpack_field(field_name, field, stream, lazy)
+        else:
+            self._unpack_field(field_name, field, stream, lazy)
+
+    def _unpack_field(self, field_name, field, stream, lazy):
+        self.logger.debug('unpacking %s.%s', self.__class__.__name__, field_name)
+
+        # setup the offset for this chunk
+        offset = field.offset
+        if offset:
+            stream.seek(offset)
+        else:
+            offset = stream.tell()
+
+        self.logger.debug('offset at %d', stream.tell())
+
+        try:
+            if lazy:
+                field.unpack(stream, lazy=True)
+            else:
+                field.unpack(stream)
+        except (UnpackException, ChunkUnpackException) as e:
+            raise _chain_exception(e, field_name)
+        field.offset = offset
+
+    def _end_of_field(self, pending, idx):
+        '''Return the offset where the field at position idx ends, unpacking it if necessary.'''
+        if idx < 0:
+            return pending.offset
+
+        name = pending.names[idx]
+
+        if name in pending:
+            self.materialize(name)
+
+        try:
+            return pending.ends[name]
+        except KeyError:  # unpacked lazily, to know where it ends we need to unpack it all
+            field = self.__dict__[name]
+            return field.offset + field.size()
+
+    def materialize(self, name, lazy=False):
+        '''Unpack the field left pending by a lazy unpack(), the fields
+        preceding it are unpacked as well if its offset is not explicit.
+
+        With lazy set to True the field (that must be a Chunk) is unpacked lazily in turn.'''
+        pending = self.__dict__['_pending']
+        # remove it right away since resolving dependencies can access it again
+        pending.pending.discard(name)
+        pending.active += 1
+
+        try:
+            stream = pending.stream
+            field = self.__dict__[name]
 
-            # setup the offset for this chunk
             offset = field.offset
+            if not offset:
+                offset = self._end_of_field(pending, pending.names.index(name) - 1)
+
+            stream.seek(offset)
+            with untracked, stream_offsets:
+                self.unpack_field(name, field, stream, lazy=lazy)
+
+            if not lazy:
+                pending.ends[name] = stream.tell()
+        finally:
+            pending.active -= 1
+
+        if not pending and not pending.active:
+            del self.__dict__['_pending']
+            self.unpack_validate()
+
+    def materialize_paths(self, *paths):
+        '''Unpack only what is needed to access the fields at the given paths,
+        like "header.e_shnum", of a chunk unpacked lazily: the sub-chunks along
+        the paths are unpacked lazily as well.'''
+        rests = {}
+        for path in paths:
+            name, _, rest = path.partition('.')
+            rests.setdefault(name, []).append(rest)
+
+        for name, rest in rests.items():
+            pending = self.__dict__.get('_pending')
+
+            if pending is None:
+                field = self.__dict__.get(name)
+            elif name not in self._meta.fields:  # we don't know what it can access
+                self.materialize_all()
+                return
+            else:
+                field = self.__dict__[name]
+
+                if name in pending:
+                    self.materialize(name, lazy=isinstance(field, Chunk) and all(rest))
+
+            if isinstance(field, Chunk):
+                if all(rest):
+                    field.materialize_paths(*rest)
+                else:
+                    field.materialize_all()
+
+    def materialize_all(self):
+        '''Unpack all the fields still pending, also of the sub-chunks.'''
+        pending = self.__dict__.get('_pending')
+
+        for name in self._meta.fields:
+            if pending is not None and name in pending:
+                self.materialize(name)
+
+            field = self.__dict__.get(name)
+
+            if isinstance(field, Chunk):
+                field.materialize_all()
+
+    def unpack_until(self, stream, *paths):
+        '''Unpack only the fields needed to access the ones at the given paths (like
+        "header.e_shnum"), in declaration order; the others are unpacked on first
+        access like with a lazy unpack().'''
+        self.unpack(stream, lazy=True)
+        self.materialize_paths(*paths)
+
+    @classmethod
+    def probe(cls, filepath, fields, **kwargs):
+        '''Return an instance with only the given fields unpacked (see unpack_until()).
+
+        For example ElfFile.probe(path, fields=['header.e_machine']) reads just
+        the ELF header.'''
+        chunk = cls(filepath, lazy=True, **kwargs)
+        chunk.materialize_paths(*fields)
+
+        return chunk
+
+    @classmethod
+    def iter_unpack(cls, filepath, count=None, **kwargs):
+        '''Yield the instances of the chunk found one after the other in the
+        stream, until its end or after count of them; each one is unpacked
+        only when requested so that a capture of any size can be processed
+        without keeping it all in memory.
+
+        For example to read the packets of a STK500 capture
+
+            for packet in STK500Packet.iter_unpack(path):
+                ...
+        '''
+        stream = filepath if isinstance(filepath, Stream) else Stream(filepath)
+        idx = 0
+
+        while count is None or idx < count:
+            if stream.at_end():
+                return
+
+            offset = stream.tell()
+            chunk = cls(stream, **kwargs)
+            chunk.offset = offset
+
+            yield chunk
+
+            idx += 1
+
+    def unpack_run(self, run, fields, stream) -> bool:
+        '''Unpack a run of StructFields with a single read, it returns False
+        if the run cannot be used and the fields must be unpacked one by one.'''
+        profiled = bool(profiling.hooks)
+
+        with profiling.counting(stream) if profiled else nullcontext() as stats:
+            if profiled:
+                seeks, start = stats.seeks, time.perf_counter()
+
+            offset = fields[0][1].offset
             if offset:
                 stream.seek(offset)
             else:
                 offset = stream.tell()
 
-            self.logger.debug('offset at %d' % stream.tell())
+            decoded = run.unpack(fields, stream)
+
+            if decoded is None:
+                return False
 
+            if profiled:
+                profiling.emit_run('unpack', [_ for __, _ in fields], [len(_) for _, __ in decoded],
+                                   time.perf_counter() - start, stats.seeks - seeks)
+
+        for (field_name, field), (data, value) in zip(fields, decoded):
             try:
-                field.unpack(stream)
+                field.set_unpacked(data, value)
             except (UnpackException, ChunkUnpackException) as e:
-                chain = e.chain if isinstance(e, ChunkUnpackException) else []
-                chain.append(field_name)
-                raise ChunkUnpackException(chain=chain)
+                raise _chain_exception(e, field_name)
             field.offset = offset
+            offset += len(data)
 
-        if hasattr(self, 'validate'):
-            ret = self.validate()
-            if not ret:
-                self.logger.warning(f'magic for field \'{self.name}\' failed')
-                if self.compliant & Compliant.MAGIC:
-                    raise MagicException(chain=[])
+        return True
+
+    def pack_run(self, run, fields, stream) -> bool:
+        '''Pack a run of StructFields with a single write, see unpack_run().'''
+        if not profiling.hooks:
+            return run.pack(fields, stream)
+
+        start = time.perf_counter()
+
+        if not run.pack(fields, stream):
+            return False
+
+        profiling.emit_run('pack', [_ for __, _ in fields], [_.size() for __, _ in fields], time.perf_counter() - start, 0)
+
+        return True
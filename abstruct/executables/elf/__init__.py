@@ -126,6 +126,56 @@ class ElfFile(Chunk):
     sections        = elf_fields.ELFSectionsField(Dependency('sections_header'))
     segments        = elf_fields.ELFSegmentsField(Dependency('segments_header'))
 
+    # the data is referred to by offset, see relayout()
+    resizable = False
+
+    def __init__(self, filepath=None, lazy_tables=False, **kwargs):
+        '''With lazy_tables the entries of the symbol and relocation tables are
+        unpacked only when accessed (see fields.LazyElements).'''
+        self.lazy_tables = lazy_tables
+
+        super().__init__(filepath, **kwargs)
+
+    def unpack(self, stream, lazy=False):
+        super().unpack(stream, lazy=lazy)
+        # from now on the data stays where it was found, see relayout()
+        self.__dict__['_unpacked'] = True
+
+    def relayout(self, offset=0):
+        '''An ELF built from scratch has the sections following the headers, the
+        one unpacked from a file instead keeps its layout: the headers, the
+        segments and the code itself refer to the data by offset, so nothing
+        can be moved. In this case a ValueError is raised if a section changed
+        size.'''
+        if not self.__dict__.get('_unpacked'):
+            return super().relayout(offset=offset)
+
+        header = self.header
+        ends = []
+
+        with fields.untracked:
+            self.offset = offset
+            ends.append(offset + header.relayout(offset=offset))
+            ends.append(header.e_shoff.value + self.sections_header.relayout(offset=header.e_shoff.value))
+            ends.append(header.e_phoff.value + self.segments_header.relayout(offset=header.e_phoff.value))
+
+            self.sections.offset = offset
+            for idx, (section_header, section) in enumerate(zip(self.sections_header, self.sections.value)):
+                if not self.sections._has_data(section_header):
+                    continue
+
+                start, size = section_header.sh_offset.value, section.size()
+
+                if size != section_header.sh_size.value:
+                    raise ValueError(f'the section {idx} changed size, an unpacked ELF can\'t be laid out again')
+
+                ends.append(start + section.relayout(offset=start))
+
+            self.segments.relayout(offset=offset)
+            ends.extend([_.p_offset.value + _.p_filesz.value for _ in self.segments_header])
+
+        return max(ends) - offset
+
     @property
     def section_names_table(self):
         '''return the string SectionStringTable with the names of the sections'''
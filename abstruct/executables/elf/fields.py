@@ -21,7 +21,7 @@ from .enum import (
     ElfSymbolType,
     ElfDynamicTagType,
 )
-from ...properties import Dependency
+from ...properties import Dependency, get_root_from_chunk
 from ...streams import Stream
 from ...exceptions import UnrecoverableException
 
@@ -46,6 +46,7 @@ class ElfIdent(Chunk):
 #       and generates the endianess to pass via the little_endian parameter.
 class Elf_DataType(fields.StructField):
     '''Wrapper for all the datatype that resolves internally to the EI_CLASS'''
+    format_from_dependencies = True
 
     def __init__(self, **kwargs):
         kwargs['endianess'] = Dependency('header.e_ident.EI_DATA')
@@ -53,15 +54,16 @@ class Elf_DataType(fields.StructField):
         self._elf_class = Dependency('header.e_ident.EI_CLASS')
 
     def get_format(self):
-        if not isinstance(self._elf_class, Enum):
+        elf_class = self._elf_class
+
+        if not isinstance(elf_class, Enum):
             self.logger.error(f'EI_CLASS has not a value useful')
             raise UnrecoverableException(chain=[])
 
         fmt = '%s%s' % (
             '<' if self.endianess == ElfEIData.ELFDATA2LSB else '>',
-            self.MAP_CLASS_TYPE[self._elf_class],
+            self.MAP_CLASS_TYPE[elf_class],
         )
-        self.logger.debug(f'format: \'{fmt}\'')
 
         return fmt
 
@@ -160,6 +162,9 @@ class SectionStringTable(fields.Field):
 
         return st[:st.find(b'\x00')].decode()
 
+    def size(self):
+        return sum([len(_.encode()) + 1 for _ in self.value])
+
     def unpack(self, stream):
         '''read all the bytes and then build as many NULL terminated strings
         as possible'''
@@ -175,10 +180,12 @@ class SectionStringTable(fields.Field):
 
         self.value = strings
 
-    def pack(self, stream=None):
-        value = b''
-        for string in self.value:
-            value += string.encode() + b'\x00'
+    def pack(self, stream=None, relayout=True):
+        value = b''.join([_.encode() + b'\x00' for _ in self.value])
+        self._contents = value
+
+        if not stream:
+            return value
 
         stream.write(value)
 
@@ -191,9 +198,9 @@ class SymbolInfoField(fields.StructField):
     def __repr__(self):
         return '<%s(%s,%s)>' % (self.__class__.__name__, self.bind, self.type)
 
-    def unpack(self, stream):
-        '''it reads and then split the values in bind and type'''
-        super().unpack(stream)
+    def unpack_value(self):
+        '''it splits the value in bind and type'''
+        super().unpack_value()
         self.bind = ElfSymbolBindType(self.value >> 4)
         self.type = ElfSymbolType(self.value & 0x0f)
 
@@ -411,78 +418,131 @@ class ELFSectionsField(fields.Field):
     def init(self):
         pass
 
+    @staticmethod
+    def _has_data(header):
+        return header.sh_type.value not in (ElfSectionType.SHT_NULL, ElfSectionType.SHT_NOBITS)
+
+    def _layout(self, offset):
+        '''Yield (header, section, offset) placing the sections one after the other
+        starting at offset, with the alignment requested by their header.'''
+        for header, section in zip(self.header, self.value or []):
+            if not self._has_data(header):
+                yield header, section, None
+                continue
+
+            align = header.sh_addralign.value
+            if align > 1:
+                offset += -offset % align
+
+            yield header, section, offset
+
+            offset += section.size()
+
     def size(self):
-        size = 0
-        for field in self.header:
-            size += field.size()
+        start = self.offset or 0
+        end = start
 
-        return size
+        for header, section, offset in self._layout(start):
+            if offset is not None:
+                end = offset + section.size()
+
+        return end - start
+
+    def relayout(self, offset=0):
+        '''Place the data of the sections updating sh_offset and sh_size
+        of the corresponding header entries.'''
+        self.offset = offset
+        end = offset
+
+        for header, section, section_offset in self._layout(offset):
+            if section_offset is None:
+                continue
+
+            size = section.relayout(offset=section_offset)
+
+            header.sh_offset.value = section_offset
+            header.sh_size.value = size
+
+            end = section_offset + size
+
+        return end - offset
 
     def pack(self, stream=None, relayout=True):
-        '''TODO: we have to update also the corresponding header entries'''
-        for field in self.header:
-            self.logger.debug('pack()()()')
+        '''Write the data of each section at the offset indicated by its header.'''
+        own = not stream
+        stream = Stream(b'') if own else stream
+
+        if relayout:
+            self.relayout(offset=self.offset or 0)
+
+        for header, section in zip(self.header, self.value or []):
+            if not self._has_data(header):
+                continue
+
+            stream.seek(header.sh_offset.value)
+            section.pack(stream=stream, relayout=False)
+
+        return stream.getvalue() if own else None
+
+    def unpack_section(self, stream, field):
+        '''Unpack the data of the section described by the header entry "field".'''
+        section_type = field.sh_type.value
+        # the tables can be unpacked lazily (see ArrayField)
+        lazy = getattr(get_root_from_chunk(self), 'lazy_tables', False)
+        self.logger.debug('found section type %s', section_type)
+        self.logger.debug('offset: %d size: %d', field.sh_offset.value, field.sh_size.value)
+
+        if section_type == ElfSectionType.SHT_STRTAB:
+            self.logger.debug('unpacking string table')
+            # we need to unpack at most sh_size bytes
+            stream.seek(field.sh_offset.value)
+            section = SectionStringTable(size=field.sh_size.value, father=self)
+            section.unpack(stream)
+        elif section_type == ElfSectionType.SHT_SYMTAB:
+            table_size = field.sh_size.value
+            self.logger.debug('unpacking symbol table')
+            n = int(table_size / SymbolTableEntry(father=self).size())  # FIXME: create Dependency w algebraic operation
+            self.logger.debug(' with %d entries', n)
+
+            stream.seek(field.sh_offset.value)
+
+            section = SymbolTable(n=n, father=self, lazy=lazy)
+            section.unpack(stream)
+        elif section_type == ElfSectionType.SHT_DYNSYM:
+            table_size = field.sh_size.value
+            self.logger.debug('unpacking dynamic symbol table')
+            n = int(table_size / SymbolTableEntry(father=self).size())  # FIXME: create Dependency w algebraic operation
+            self.logger.debug(' with %d entries', n)
+
+            stream.seek(field.sh_offset.value)
+
+            section = SymbolTable(n=n, father=self, lazy=lazy)
+            section.unpack(stream)
+        elif section_type == ElfSectionType.SHT_REL:
+            from .reloc import ElfRelTable
+            from .reloc import ElfRelEntry
+            table_size = field.sh_size.value
+
+            self.logger.debug('unpacking relocation table')
+            n = int(table_size / ElfRelEntry(father=self).size())  # FIXME: create Dependency w algebraic operation
+            self.logger.debug(' with %d entries', n)
+
+            stream.seek(field.sh_offset.value)
+
+            section = ElfRelTable(n=n, father=self, lazy=lazy)
+            section.unpack(stream)
+        else:
+            self.logger.debug('unpacking unhandled data of type %s', section_type)
+            stream.seek(field.sh_offset.value)
+            section = fields.StringField(field.sh_size.value, zero_copy=True, father=self)
+            section.unpack(stream)
+
+        section.offset = field.sh_offset.value
+
+        return section
 
     def unpack(self, stream):
-        self.value = []  # reset the entries
-        for field in self.header:
-            section_type = field.sh_type.value
-            self.logger.debug('found section type %s' % section_type)
-            self.logger.debug('offset: %d size: %d' % (field.sh_offset.value, field.sh_size.value))
-
-            if section_type == ElfSectionType.SHT_STRTAB:
-                self.logger.debug('unpacking string table')
-                # we need to unpack at most sh_size bytes
-                stream.seek(field.sh_offset.value)
-                section = SectionStringTable(size=field.sh_size.value)
-                section.unpack(stream)
-                self.value.append(section)
-            elif section_type == ElfSectionType.SHT_SYMTAB:
-                table_size = field.sh_size.value
-                self.logger.debug('unpacking symbol table')
-                n = int(table_size / SymbolTableEntry(father=self).size())  # FIXME: create Dependency w algebraic operation
-                self.logger.debug(' with %d entries' % n)
-
-                stream.seek(field.sh_offset.value)
-
-                section = SymbolTable(n=n, father=self)
-                section.unpack(stream)
-
-                self.value.append(section)
-            elif section_type == ElfSectionType.SHT_DYNSYM:
-                table_size = field.sh_size.value
-                self.logger.debug('unpacking dynamic symbol table')
-                n = int(table_size / SymbolTableEntry(father=self).size())  # FIXME: create Dependency w algebraic operation
-                self.logger.debug(' with %d entries' % n)
-
-                stream.seek(field.sh_offset.value)
-
-                section = SymbolTable(n=n, father=self)
-                section.unpack(stream)
-
-                self.value.append(section)
-            elif section_type == ElfSectionType.SHT_REL:
-                from .reloc import ElfRelTable
-                from .reloc import ElfRelEntry
-                table_size = field.sh_size.value
-
-                self.logger.debug('unpacking relocation table')
-                n = int(table_size / ElfRelEntry(father=self).size())  # FIXME: create Dependency w algebraic operation
-                self.logger.debug(' with %d entries' % n)
-
-                stream.seek(field.sh_offset.value)
-
-                section = ElfRelTable(n=n, father=self)
-                section.unpack(stream)
-
-                self.value.append(section)
-            else:
-                self.logger.debug('unpacking unhandled data of type %s' % section_type)
-                stream.seek(field.sh_offset.value)
-                section = fields.StringField(field.sh_size.value)
-                section.unpack(stream)
-
-                self.value.append(section)
+        self.value = [self.unpack_section(stream, _) for _ in self.header]
 
 
 class ELFSegmentsField(fields.Field):
@@ -520,18 +580,34 @@ class ELFSegmentsField(fields.Field):
 
         return None
 
+    def relayout(self, offset=0):
+        '''The segments are views over the data of the file (usually the same
+        of the sections), each one stays at the offset indicated by its header.'''
+        self.offset = offset
+
+        for header, segment in zip(self.header, self.value):
+            segment.relayout(offset=header.p_offset.value)
+
+        return self.size()
+
     def pack(self, stream=None, relayout=True):
-        '''TODO: we have to update also the corresponding header entries'''
-        raw = b''
-        for field in self.value:
-            self.logger.debug('pack()()()')
-            raw += field.pack(stream)  # FIXME: if stream is None
+        '''Write the data of each segment at the offset indicated by its header.
+        TODO: we have to update also the corresponding header entries'''
+        own = not stream
+        stream = Stream(b'') if own else stream
+
+        if relayout:
+            self.relayout(offset=self.offset or 0)
+
+        for header, segment in zip(self.header, self.value):
+            stream.seek(header.p_offset.value)
+            segment.pack(stream=stream, relayout=False)
 
-        return raw
+        return stream.getvalue() if own else None
 
     def _handle_unpack_PT_PHDR(self, entry):
         '''It handles the header, simply using a StringField'''
-        field = fields.StringField(n=entry.p_filesz.value)
+        field = fields.StringField(n=entry.p_filesz.value, zero_copy=True)
 
         return field
 
@@ -546,7 +622,7 @@ class ELFSegmentsField(fields.Field):
         return dyn
 
     def _handle_unpack_undefined(self, entry):
-        field = fields.StringField(offset=entry.p_offset.value, n=entry.p_filesz.value)
+        field = fields.StringField(offset=entry.p_offset.value, n=entry.p_filesz.value, zero_copy=True)
 
         return field
 
@@ -37,8 +37,8 @@ class ElfRelocationInfoField(Elf_Xword):
             ElfMachine.EM_X86_64: 0xffffffff,
         }[self._arch]
 
-    def unpack(self, stream):
-        super().unpack(stream)
+    def unpack_value(self):
+        super().unpack_value()
 
         self.sym  = self.value >> self.get_shift()
         self.type = self.get_relocation_type()
@@ -1,15 +1,19 @@
 import logging
 import struct
-import copy
+import threading
+from collections import OrderedDict
 from enum import Enum, Flag, auto
-from typing import Dict
 
 from .enum import Compliant
-from .properties import Dependency, ChunkPhase
+from . import properties
+from .properties import Dependency, ChunkPhase, invalidate_dependencies, invalidate_sizes
 from .streams import Stream
 from .exceptions import UnpackException, MagicException
 
 
+logger = logging.getLogger(__name__)
+
+
 class Endianess(Enum):
     LITTLE_ENDIAN = auto()
     BIG_ENDIAN    = auto()
@@ -17,6 +21,40 @@ class Endianess(Enum):
     NATIVE        = auto()
 
 
+_tracking = threading.local()
+
+
+class Untracked(object):
+    '''Context manager: the values written in the block by the same thread
+    are not marked as dirty (see Field.mark_dirty()), it's used while
+    unpacking and packing since those writes are not modifications.'''
+
+    def __enter__(self):
+        _tracking.depth = getattr(_tracking, 'depth', 0) + 1
+
+    def __exit__(self, *args):
+        _tracking.depth -= 1
+
+
+untracked = Untracked()
+
+
+class StreamOffsets(object):
+    '''Context manager: the offsets assigned in the block by the same thread
+    are the positions of the fields in the stream (it's used while unpacking),
+    they are remembered apart from the ones assigned by relayout() so that
+    Chunk.repack() knows where to write after a pack().'''
+
+    def __enter__(self):
+        _tracking.stream_offsets = getattr(_tracking, 'stream_offsets', 0) + 1
+
+    def __exit__(self, *args):
+        _tracking.stream_offsets -= 1
+
+
+stream_offsets = StreamOffsets()
+
+
 class FieldDescriptor(object):
 
     def __init__(self, field_instance, field_name):
@@ -25,28 +63,63 @@ class FieldDescriptor(object):
 
     def __get__(self, instance, type=None):
         data = instance.__dict__
+        name = self.field.name
 
-        if self.field.name in data:
-            return data[self.field.name]
+        if name in data:
+            field = data[name]
         else:
-            new_field = self.field.create(father=instance)
-            data[self.field.name] = new_field
-            return data[self.field.name]
+            field = self.field.create(father=instance)
+            data[name] = field
+
+        # the instance was unpacked lazily and this field is still waiting
+        pending = data.get('_pending')
+        if pending is not None and name in pending:
+            instance.materialize(name)
+
+        return field
 
     def __set__(self, instance, value):
         data = instance.__dict__
 
+        pending = data.get('_pending')
+        if pending is not None and self.field.name in pending:
+            instance.materialize(self.field.name)
+
         # if the value is the same type then set as it is
         if isinstance(value, self.field.__class__):
+            old = data.get(self.field.name)
+
             value.father = instance
             value.name = self.field.name
             data[self.field.name] = value
+            invalidate_dependencies()
+
+            # it takes the place of the old one in the stream
+            value.mark_dirty(like=old)
         # otherwise delegate to the field
         else:
-            data[self.field.name].set(value)
+            self.__get__(instance).value = value
+
+
+def _copy_argument(value):
+    '''Mutable containers passed to a constructor are copied so that instances
+    created from the same prototype don't share them.'''
+    if isinstance(value, (list, dict, set, bytearray)):
+        return value.copy()
+
+    return value
 
 
 class FieldBase(object):
+    '''Each instance remembers the arguments it was constructed with so that
+    it can be used as a prototype: create() builds a fresh instance calling
+    the constructor again instead of copying the whole object graph.'''
+
+    def __new__(cls, *args, **kwargs):
+        instance = super().__new__(cls)
+        instance.__dict__['_arguments'] = (args, kwargs)
+
+        return instance
 
     def contribute_to_chunk(self, cls, name):
         if not getattr(cls, name, None):
@@ -55,27 +128,46 @@ class FieldBase(object):
             raise AttributeError(f'field {name} is already present in class {cls.__name__}')
 
     def create(self, father):
-        instance = copy.deepcopy(self)
-        instance.father = father
+        '''Return a new instance built like this one with the given father.
+
+        Note that only the constructor's arguments (and the name) are used,
+        any change done to the prototype after its creation is not propagated.'''
+        args, kwargs = self._arguments
+
+        kwargs = {key: _copy_argument(value) for key, value in kwargs.items()}
+        kwargs['father'] = father
+
+        instance = self.__class__(*[_copy_argument(_) for _ in args], **kwargs)
+        instance.name = self.name
+
         return instance
 
 
 class Field(FieldBase):
+    # the value is kept in the instance, i.e. it changes only when the field
+    # is written, so it can be cached by the dependencies resolving it
+    stored_value = True
+    # the size is memoized by size() (see get_cached_size())
+    caches_size = False
 
     def __init__(self, *args, name=None, father=None, default=None, offset=None, endianess=Endianess.LITTLE_ENDIAN, compliant=Compliant.INHERIT, is_magic=False):
         super().__init__()
-        self.logger = logging.getLogger(__name__)
-        self._dependencies: Dict[str, Dependency] = {}
-        self._resolve = True  # TODO: create contextmanager
-        self.name = name
-        self.father = father
+        # the plain attributes are set directly, only the ones that can be
+        # a Dependency need to pass from __setattr__()
+        self.__dict__.update({
+            'logger': logger,
+            '_dependencies': {},
+            '_resolve': True,  # TODO: create contextmanager
+            'name': name,
+            'father': father,
+            '_value': None,
+            '_data': None,
+            'compliant': compliant,
+            'is_magic': is_magic,
+        })
         self.default = default
         self.offset = offset
-        self._value = None
-        self._data = None
         self.endianess = endianess
-        self.compliant = compliant
-        self.is_magic = is_magic
 
         # self.init() # FIXME: chose a convention for defining the default, maybe init_default() called from init()
 
@@ -91,9 +183,8 @@ class Field(FieldBase):
 
     def __getattribute__(self, name):
         '''If the field is a Field then return directly the 'value' attribute'''
-        field = super().__getattribute__(name)
-        if isinstance(field, Dependency) and self._resolve:
-            self.logger.debug('trying to resolve dependency for \'%s\' from \'%s\'' % (name, self.name))
+        field = object.__getattribute__(self, name)
+        if isinstance(field, Dependency) and object.__getattribute__(self, '__dict__')['_resolve']:
             return field.resolve(self)
 
         return field
@@ -106,32 +197,97 @@ class Field(FieldBase):
         # remember that this is going to be called at Chunk construction time, so no
         # initialization is yet done on the parents of this instance, so you CANNOT resolve
         # dependencies
-        self.__dict__['_resolve'] = False
+        data = object.__getattribute__(self, '__dict__')  # avoid our own __getattribute__()
+        data['_resolve'] = False
+        if name == 'father' and data.get('father') not in (None, value):
+            invalidate_dependencies()  # we are moving under another tree
         if isinstance(value, Dependency):
-            self.logger.debug(f'setting dependency for field \'{name}\': {value}')
-            self._dependencies[name] = value
+            self.logger.debug('setting dependency for field \'%s\': %s', name, value)
+            data.setdefault('_dependencies', {})[name] = value
         try:
             # the try block is needed in order to catch initialization of variables
             # for the first time
             # try to see if is a property
-            field = getattr(self.__class__, name, None)
+            field = getattr(type(self), name, None)
             # FIXME: doesn't work if @x.setter is used, do you know why?
             if isinstance(field, property) and field.fset is not None:
                 return field.fset(self, value)
-            field = super().__getattribute__(name)
-            self.__dict__['_resolve'] = True
+            field = data.get(name, field)
+            data['_resolve'] = True
             if isinstance(field, Dependency):
-                self.logger.debug('set for field \'%s\' the value \'%s\' depends on' % (name, value))
+                self.logger.debug('set for field \'%s\' the value \'%s\' depends on', name, value)
                 real_field = field.resolve_field(self)
-                real_field.value = value
+                real_field.value = field.inverse(value)
                 return
 
         except AttributeError:
             pass
         finally:
-            self.__dict__['_resolve'] = True  # FIXME
+            data['_resolve'] = True  # FIXME
 
         super().__setattr__(name, value)
+        # any write invalidates the values cached by the dependencies
+        data['_version'] = data.get('_version', 0) + 1
+
+        # and the sizes cached by the ancestors (or by anyone if a dependency points here)
+        if data.get('_dependency_target'):
+            invalidate_sizes()
+        self.invalidate_size()
+
+    def get_cached_size(self):
+        '''Return the size cached by size(), None if it's not valid anymore.'''
+        cache = self.__dict__.get('_size_cache')
+
+        if cache is not None and cache[0] == properties._size_epoch:
+            return cache[1]
+
+        return None
+
+    def set_cached_size(self, size):
+        self.__dict__['_size_cache'] = (properties._size_epoch, size)
+
+        return size
+
+    def invalidate_size(self):
+        '''Forget the size cached by this field and by its ancestors, it's done
+        automatically when an attribute is written but it must be called after
+        changing a value in place (like appending to the list of an ArrayField).'''
+        field = self
+
+        while field is not None:
+            data = field.__dict__
+            # an ancestor caches its size only if its descendants do
+            if data.pop('_size_cache', None) is None and field.caches_size:
+                break
+
+            field = data.get('father')
+
+    def mark_dirty(self, like=None):
+        '''Remember that the field was modified so that Chunk.repack() can rewrite
+        only it; the first time the range it occupies in the stream (or the one
+        of the field it replaces, like) is recorded. Only the trees unpacked from
+        a stream are tracked.'''
+        if getattr(_tracking, 'depth', 0):
+            return
+
+        root = self
+        while root.__dict__['father'] is not None:
+            root = root.__dict__['father']
+
+        dirty = root.__dict__.get('_dirty')
+
+        if dirty is None or id(self) in dirty:
+            return
+
+        like = self if like is None else like
+
+        # we are called from __setattr__() that disables the resolution of the dependencies
+        old_resolve = like.__dict__['_resolve']
+        like.__dict__['_resolve'] = True
+        try:
+            dirty[id(self)] = (self, like.__dict__.get('_stream_offset'), like.size())
+        finally:
+            like.__dict__['_resolve'] = old_resolve
 
     def get_dependencies(self):
         """Return the dictionary containing as key the field"""
@@ -151,6 +307,9 @@ class Field(FieldBase):
         return False
 
     def __set_offset(self, value):
+        if getattr(_tracking, 'stream_offsets', 0) and not isinstance(value, Dependency):
+            self.__dict__['_stream_offset'] = value
+
         self.__offset = value
 
     def __get_offset(self):
@@ -159,6 +318,7 @@ class Field(FieldBase):
     offset = property(__get_offset, __set_offset)
 
     def _set_value(self, value) -> None:
+        self.mark_dirty()
         self._value = value
 
     def _get_value(self):
@@ -196,6 +356,10 @@ class Field(FieldBase):
         '''The pack-ing action needs to take into consideration the fact that we need
         to eventually update fields that depends on other fields
 
+        The data is returned only if no stream is passed, otherwise it's written
+        into the stream and nothing is returned (the stream can be a file or a
+        buffer shared by all the fields, copying it each time would be quadratic).
+
         This operation is not idempotent!
         '''
         raise NotImplemented('you need to implement this in the subclass')
@@ -205,6 +369,9 @@ class Field(FieldBase):
 
 
 class StructField(Field):
+    # True if get_format(), when overridden, uses only the dependencies of the
+    # field so that the compiled plans can check them (see abstruct.plan)
+    format_from_dependencies = False
 
     # FIXME: make the enum internal mechanism overridable so to have arch-dependent-enums
     def __init__(self, format, default=0, equals_to=None, enum=None, **kw):  # decide between default and equals_to
@@ -226,7 +393,7 @@ class StructField(Field):
             return self.value.decode('latin1')
         width = self.size() * 2  # we want to be as large as possible
         formatter = '0x%%0%dx' % width
-        return formatter % (self.value if not self.enum else self.value.value,)
+        return formatter % (self.get_raw_value(),)
 
     def value_from_default(self):
         if not self.enum:
@@ -234,6 +401,12 @@ class StructField(Field):
 
         return self.enum(self.default)
 
+    def get_raw_value(self):
+        '''Return the value to pack: a value not in the enum is kept as is when unpacked.'''
+        value = self.value
+
+        return value.value if isinstance(value, Enum) else value
+
     def get_format(self):
         return '%s%s' % ('<' if self.endianess == Endianess.LITTLE_ENDIAN else '>', self.format)
 
@@ -242,20 +415,23 @@ class StructField(Field):
 
     @property
     def raw(self):
+        if self._data is None:  # packed in place (see Stream.write_packed())
+            self._data = struct.pack(self.get_format(), self.get_raw_value())
+
         return self._data
 
     def pack(self, stream=None, relayout=True):
         self._update_value()
-        packed_value = struct.pack(self.get_format(), self.value if not self.enum else self.value.value)
-        self._data = packed_value
 
-        stream = stream if stream else Stream(b'')
+        if not stream:
+            self._data = struct.pack(self.get_format(), self.get_raw_value())
+            self._phase = ChunkPhase.DONE
 
-        stream.write(packed_value)
+            return self._data
 
-        self._phase = ChunkPhase.DONE
+        self._data = stream.write_packed(self.get_format(), self.get_raw_value())
 
-        return stream.getvalue()
+        self._phase = ChunkPhase.DONE
 
     def unpack_struct(self):
         try:
@@ -281,9 +457,10 @@ class StructField(Field):
 
                 self.logger.warning(f'enum {self.enum!r} doesn\'t have element with value 0x{self.value:x} in it')
 
-    def unpack(self, stream):
-        self._data = stream.read(self.size())
-        self.unpack_struct()
+    def unpack_value(self):
+        '''Here the value just decoded is interpreted: subclasses that need
+        to derive something from it should override this instead of unpack()
+        so that they can be unpacked also as part of a compiled run (see abstruct.plan).'''
         self.unpack_enum()
 
         if self.is_magic and self.value != self.default:
@@ -291,17 +468,35 @@ class StructField(Field):
             if self.is_compliant(Compliant.MAGIC):
                 raise MagicException(chain=[])
 
+    def set_unpacked(self, data, value):
+        '''Set the field from a value already decoded, with data the raw bytes
+        it was decoded from.'''
+        self._data = data
+        self.value = value
+        self.unpack_value()
+
+    def unpack(self, stream):
+        self._data = stream.read(self.size())
+        self.unpack_struct()
+        self.unpack_value()
+
 
 # TODO: understand if it is needed to separate from Binary and alphanumeric strings.
 class StringField(Field):
-    """Represent a contiguous chunk of bytes."""
+    """Represent a contiguous chunk of bytes.
 
-    def __init__(self, n=0, **kw):
+    With zero_copy set to True, if the stream supports it (see Stream.read_view())
+    the value is a memoryview referencing the stream's data instead of a copy,
+    useful for big payloads."""
+
+    def __init__(self, n=0, zero_copy=False, **kw):
         super().__init__(**kw)
         self._n = n
+        self.zero_copy = zero_copy
 
     def __repr__(self):
-        return '<%s(%s)>' % (self.__class__.__name__, repr(self.value))
+        value = self.value
+        return '<%s(%s)>' % (self.__class__.__name__, repr(value if not isinstance(value, memoryview) else value.tobytes()))
 
     def __len__(self):
         return len(self.value)
@@ -321,21 +516,84 @@ class StringField(Field):
         return self.value
 
     def pack(self, stream=None, relayout=True):
-        stream = Stream(b'') if not stream else stream
-
-        stream.write(self.value)
-
         self._phase = ChunkPhase.DONE
 
-        return stream.obj.getvalue()
+        if not stream:
+            return bytes(self.value)
+
+        stream.write(self.value)
 
     def unpack(self, stream):
-        self.value = stream.read(self._n)
+        self.value = stream.read(self._n) if not self.zero_copy else stream.read_view(self._n)
 
         if self.is_magic and self.value != self.default:
             raise MagicException(chain=None)
 
 
+class LazyElements(object):
+    '''The elements of an ArrayField unpacked lazily: each one is unpacked
+    from the stream the first time it's accessed and at most cache_size of
+    them are kept, the least recently used are discarded (and unpacked again
+    if needed).
+
+    Since an element can be discarded the changes done to it can be lost:
+    to modify the array use to_list() (append() does it by itself).'''
+
+    def __init__(self, array, stream, offset, n, cache_size):
+        self.array = array
+        self.stream = stream
+        self.offset = offset  # where the array was unpacked from
+        self.n = n
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}(n={self.n}, cached={len(self.cache)})>'
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[_] for _ in range(*idx.indices(self.n))]
+
+        if idx < 0:
+            idx += self.n
+
+        if not 0 <= idx < self.n:
+            raise IndexError(f'element {idx} out of range')
+
+        element = self.cache.get(idx)
+
+        if element is not None:
+            self.cache.move_to_end(idx)
+            return element
+
+        element = self.array.unpack_element_at(self.stream, idx, start=self.offset)
+        self.cache[idx] = element
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return element
+
+    def __iter__(self):
+        for idx in range(self.n):
+            yield self[idx]
+
+    def to_list(self):
+        '''Return all the elements, the ones in the cache are reused.'''
+        elements = []
+
+        for idx in range(self.n):
+            element = self.cache.get(idx)  # an element can be falsy, e.g. an empty string
+            if element is None:
+                element = self.array.unpack_element_at(self.stream, idx, start=self.offset)
+            elements.append(element)
+
+        return elements
+
+
 class ArrayField(Field):
     '''Un/Pack an array of Chunks.
 
@@ -345,10 +603,17 @@ class ArrayField(Field):
 
     This class must behave like a list in python, obviously cannot implement all the methods
     since, for example, slicing what should mean?
+
+    With lazy set to True and elements of fixed size (see element_size()) the
+    value after unpacking is a LazyElements, that unpacks only the elements
+    accessed keeping at most cache_size of them.
     '''
+    caches_size = True
 
-    def __init__(self, field_cls, n=0, canary=None, **kw):
+    def __init__(self, field_cls, n=0, canary=None, lazy=False, cache_size=256, **kw):
         self.field_cls = field_cls
+        self.lazy = lazy
+        self.cache_size = cache_size
         if n and not (isinstance(n, Dependency) or isinstance(n, int)):
             raise Exception('n is \'%s\' must be of the right type' % n.__class__.__name__)
 
@@ -375,7 +640,7 @@ class ArrayField(Field):
         self._n = len(self.value)
 
     def clear(self):
-        self.value.clear()
+        self.value = []
 
     @property
     def raw(self):
@@ -385,29 +650,90 @@ class ArrayField(Field):
 
         return value
 
-    def size(self):
-        size = 0
-        for element in self.value:
-            size += element.size()
+    def element_size(self):
+        '''Return the size of each element if it's the same for all of them
+        (see plan.has_fixed_size()), None otherwise.'''
+        from .plan import has_fixed_size  # plan imports this module
+
+        if not has_fixed_size(self.field_cls):
+            return None
+
+        # the size can still depend on fields outside of the array (think of EI_CLASS)
+        cache = self.__dict__.get('_element_size')
+        if cache is not None and cache[0] == properties._size_epoch:
+            return cache[1]
+
+        size = self.instance_element().size()
+        self.__dict__['_element_size'] = (properties._size_epoch, size)
 
         return size
 
+    def element_offset(self, idx, start=None):
+        '''Return the offset of the element at position idx (for the array starting
+        at start, by default its offset) without looking at the ones preceding it,
+        possible only if the elements have a fixed size.'''
+        element_size = self.element_size()
+
+        if element_size is None:
+            raise ValueError(f'the elements of {self.__class__.__name__} have not a fixed size')
+
+        return (self.offset if start is None else start) + idx * element_size
+
+    def unpack_element_at(self, stream, idx, start=None):
+        '''Return the element at position idx unpacked from the stream, the
+        elements preceding it are not unpacked (see element_offset()).'''
+        offset = self.element_offset(idx, start=start)
+        stream.seek(offset)
+
+        element = self.instance_element()
+        with untracked, stream_offsets:
+            self.unpack_element(element, stream)
+            element.offset = offset
+
+        return element
+
+    def size(self):
+        size = self.get_cached_size()
+        if size is not None:
+            return size
+
+        element_size = self.element_size()
+
+        if element_size is not None:
+            size = len(self.value) * element_size
+        else:
+            size = 0
+            for element in self.value:
+                size += element.size()
+
+        return self.set_cached_size(size)
+
     def relayout(self, offset=0):
-        super().relayout(offset=offset)
+        self.offset = offset
+        start = offset
         for field in self.value:
             offset += field.relayout(offset=offset)
 
-        return offset
+        return offset - start
 
     def pack(self, stream=None, relayout=True):
-        data = b''
         if relayout:
             self.relayout()
 
-        for field in self.value:
-            data += field.pack(stream=stream, relayout=False)
+        own = not stream
+        stream = Stream(b'') if own else stream
+
+        lazy = isinstance(self.value, LazyElements)
 
-        return data  # FIXME
+        # the elements write themselves into the stream, concatenating what
+        # they return would copy the data over and over
+        for idx, field in enumerate(self.value):
+            if lazy:  # the element could have been unpacked again after the relayout
+                field.relayout(offset=self.element_offset(idx))
+
+            field.pack(stream=stream, relayout=False)
+
+        return stream.getvalue() if own else None
 
     def instance_element(self):
         return self.field_cls.create(father=self)  # pass the father so that we don't lose the hierarchy
@@ -416,6 +742,9 @@ class ArrayField(Field):
         element.unpack(stream)
 
     def append(self, element):
+        if isinstance(self.value, LazyElements):
+            self.value = self.value.to_list()
+
         element.father = self
         self.value.append(element)
         self._n = len(self.value)
@@ -424,22 +753,40 @@ class ArrayField(Field):
         '''Unpack the data found in the stream creating new elements,
         the old one, if present, are discarded.'''
         self._value = []  # reset the fields already present
+
+        if self.lazy and self._canary is None and self._n and self.element_size() is not None:
+            count = self._n
+            self.offset = stream.tell()
+            self._value = LazyElements(self, stream, self.offset, count, self.cache_size)
+            # leave the stream at the end of the array like the eager unpacking
+            stream.seek(self.element_offset(count))
+
+            return
+
+        for element in self.iter_unpack(stream):
+            self.append(element)
+
+    def iter_unpack(self, stream):
+        '''Yield the elements as they are unpacked from the stream, without
+        keeping them in the array (that is left untouched) so that the memory
+        used doesn't grow with the number of elements.'''
         idx = 0
 
         if self._canary is None and self._n == 0:  # if we don't have anything to unpack we can exit right away
             return
 
-        count = self._n  # use the actual value since the loop is going to modify it
+        count = self._n  # use the actual value since unpack() is going to modify it
 
         while True:
             element = self.instance_element()
-            self.logger.debug('%s: unpacking item %d' % (self.__class__.__name__, idx))
+            self.logger.debug('%s: unpacking item %d', self.__class__.__name__, idx)
 
             element_offset = stream.tell()
-            self.unpack_element(element, stream)
-            element.offset = element_offset
+            with untracked, stream_offsets:  # not around the yield, the consumer can modify the element
+                self.unpack_element(element, stream)
+                element.offset = element_offset
 
-            self.append(element)
+            yield element
 
             idx += 1
 
@@ -478,6 +825,8 @@ class SelectField(Field):
     class Type(Flag):
         DEFAULT = auto()
 
+    stored_value = False  # the value is the one of the selected field
+
     def __init__(self, key, mapping, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._key = key
@@ -489,28 +838,67 @@ class SelectField(Field):
     def init(self):
         pass
 
+    def _get_key(self):
+        field_key = getattr(self.father, self._key)
+
+        return field_key.value if field_key.value in self._mapping else SelectField.Type.DEFAULT
+
+    def _create_field(self, key):
+        field_class, args, kwargs = self._mapping[key]
+        field = field_class(*args, **kwargs)
+        field.father = self.father  # FIXME
+
+        self.__dict__['_selected'] = key
+        self._field = field
+
+        return field
+
+    def get_field(self):
+        '''Return the field selected by the actual value of the key, a new
+        one is created if the key has changed.'''
+        key = self._get_key()
+        field = self.__dict__.get('_field')
+
+        if field is None or self.__dict__.get('_selected') != key:
+            self.logger.debug('selecting field for key \'%s\'', key)
+            field = self._create_field(key)
+
+        return field
+
     def _get_value(self):
-        return self._field.value
+        return self.get_field().value
+
+    def _set_value(self, value):
+        self.get_field().value = value
 
     @property
     def raw(self):
         return self._field.raw
 
-    def unpack(self, stream):
-        self.logger.debug('resolving key \'%s\'' % self._key)
-        field_key = getattr(self.father, self._key)
+    def size(self):
+        return self.get_field().size()
 
-        key = field_key.value if field_key.value in self._mapping else SelectField.Type.DEFAULT
+    def relayout(self, offset=0):
+        self.offset = offset
 
-        self.logger.debug('using key to \'%s\' (original was \'%s\')' % (key, field_key.value))
+        return self.get_field().relayout(offset=offset)
 
-        field_class, args, kwargs = self._mapping[key]
-        self._field = field_class(*args, **kwargs)
-        self._field.father = self.father  # FIXME
-        self.logger.debug(f'unpacking {self._field!r}')
+    def pack(self, stream=None, relayout=True):
+        return self.get_field().pack(stream=stream, relayout=relayout)
+
+    def unpack(self, stream):
+        self.logger.debug('resolving key \'%s\'', self._key)
+        key = self._get_key()
 
-        self._field.unpack(stream)
-        self.logger.debug(f'unpacked {self._field!r}')
+        self.logger.debug('using key to \'%s\'', key)
+
+        field = self._create_field(key)
+        self.logger.debug('unpacking %r', field)
+
+        offset = stream.tell()
+        field.unpack(stream)
+        field.offset = offset
+        self.logger.debug('unpacked %r', field)
 
 
 class PaddingField(Field):
@@ -521,3 +909,6 @@ class PaddingField(Field):
 
     def init(self):
         pass
+
+    def size(self):
+        return len(self.value or b'')
@@ -86,7 +86,7 @@ type2field = {
     b'IHDR': (IHDRData, (), {}),
     b'PLTE': (fields.ArrayField, (PLTEEntry(),), {'n': RatioDependency(3, '.length')}),
     b'gAMA': (fields.StringField, (Dependency('.length'),), {}),
-    fields.SelectField.Type.DEFAULT: (fields.StringField, (Dependency('.length'),), {}),
+    fields.SelectField.Type.DEFAULT: (fields.StringField, (Dependency('.length'),), {'zero_copy': True}),
 }
 
 
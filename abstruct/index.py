@@ -0,0 +1,407 @@
+'''
+Persistent index of the values extracted from parsed files.
+
+A Record maps the paths used to reach a value starting from a parsed object
+(like ("header", "e_machine", "value")) to the value itself; it's filled by
+a RecordingProxy wrapping the object while some code (e.g. the condition of
+scripts/find.py) accesses it, and it can be used in place of the object by
+a ReplayProxy, that raises MissingPath for anything not recorded.
+
+Any other operation on a field (comparing it, converting it to a string or
+a number, etc...) is done on the field itself but its result depends on
+something not recorded, so the record is marked as incomplete and not stored.
+
+The ScanIndex stores the records in a sqlite database keyed by the path of
+the file and the format it was parsed with, a record is valid as long as the
+size and the modification time of the file don't change; a file that is not
+of the given format is stored with None as record. The records are encoded
+as JSON (see Record.dumps()), reading the database never runs any code.
+'''
+import json
+import logging
+import operator
+import os
+import sqlite3
+import sys
+from enum import Enum
+from typing import Any, Iterable, Optional, Tuple
+
+from .fields import FieldBase
+
+
+logger = logging.getLogger(__name__)
+
+
+class MissingPath(KeyError):
+    '''The path is not in the record.'''
+
+
+class Record(object):
+    '''The values reached from a parsed object, keyed by their path: an
+    attribute is a string component, an item is a tuple ("[]", key).'''
+
+    def __init__(self):
+        self.values = {}
+        self.nodes = set([()])  # the paths leading to a field
+        self.complete = True  # False if some value couldn't be recorded
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({self.values!r})>'
+
+    def __getstate__(self):
+        return {'values': self.values, 'nodes': self.nodes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.complete = True
+
+    def dumps(self) -> str:
+        '''Encode the values and the nodes as JSON, see loads().'''
+        return json.dumps({
+            'values': [[_encode_path(path), _encode(value)] for path, value in self.values.items()],
+            'nodes': [_encode_path(_) for _ in self.nodes],
+        })
+
+    @classmethod
+    def loads(cls, data: str) -> 'Record':
+        '''Decode a record encoded by dumps(), it raises ValueError if
+        the data is not valid.'''
+        try:
+            state = json.loads(data)
+            record = cls()
+            record.values = {_decode_path(path): _decode(value) for path, value in state['values']}
+            record.nodes = set([_decode_path(_) for _ in state['nodes']])
+        except (TypeError, KeyError, AttributeError) as e:
+            raise ValueError(f'invalid record: {e}') from e
+
+        return record
+
+    def get(self, expression: str) -> Any:
+        '''Return the value recorded for an expression like "header.e_machine.value".'''
+        return self.values[tuple(expression.split('.'))]
+
+    @classmethod
+    def from_object(cls, obj, expressions: Iterable[str]) -> 'Record':
+        '''Record the values of obj reached by the given expressions.'''
+        record = cls()
+        proxy = RecordingProxy(obj, record)
+
+        for expression in expressions:
+            value = proxy
+            for component in expression.split('.'):
+                value = getattr(value, component)
+
+        return record
+
+
+def _is_plain(value) -> bool:
+    '''Only the values that can be stored and compared safely are recorded.'''
+    if isinstance(value, Enum):  # it must be found again by name, see _decode()
+        return '<locals>' not in type(value).__qualname__
+
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        return True
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all([_is_plain(_) for _ in value])
+
+    return False
+
+
+def _plain(value):
+    return value.tobytes() if isinstance(value, memoryview) else value
+
+
+def _encode(value):
+    '''Return a JSON-compatible form of a plain value (see _is_plain()), the
+    types JSON doesn't have are tagged by a dictionary with a single key.'''
+    if isinstance(value, Enum):
+        cls = type(value)
+        return {'enum': [cls.__module__, cls.__qualname__, _encode(value.value)]}
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    if isinstance(value, bytes):
+        return {'bytes': value.hex()}
+
+    return {type(value).__name__: [_encode(_) for _ in value]}
+
+
+_CONTAINERS = {
+    'list': list,
+    'tuple': tuple,
+    'set': set,
+    'frozenset': frozenset,
+}
+
+
+def _decode(data):
+    if not isinstance(data, dict):
+        return data
+
+    (tag, value), = data.items()
+
+    if tag == 'bytes':
+        return bytes.fromhex(value)
+
+    if tag == 'enum':
+        module_name, qualname, raw = value
+        # only the enums already imported, the module is not loaded from the data
+        cls = sys.modules.get(module_name)
+        for name in qualname.split('.') if cls is not None else []:
+            cls = getattr(cls, name, None)
+
+        if not isinstance(cls, type) or not issubclass(cls, Enum):
+            raise ValueError(f'unknown enum {module_name}.{qualname}')
+
+        return cls(_decode(raw))
+
+    if tag in _CONTAINERS:
+        return _CONTAINERS[tag]([_decode(_) for _ in value])
+
+    raise ValueError(f'unknown tag \'{tag}\'')
+
+
+def _encode_path(path: Tuple) -> list:
+    return [_ if isinstance(_, str) else {'[]': _encode(_[1])} for _ in path]
+
+
+def _decode_path(data: list) -> Tuple:
+    return tuple([_ if isinstance(_, str) else ('[]', _decode(_['[]'])) for _ in data])
+
+
+def _unwrap(value):
+    return object.__getattribute__(value, '_target') if isinstance(value, RecordingProxy) else value
+
+
+# the operations forwarded to the field by RecordingProxy and refused by
+# ReplayProxy, the attributes, the items, len() and bool() are recorded
+_UNARY = {
+    '__str__': str,
+    '__repr__': repr,
+    '__format__': format,
+    '__hash__': hash,
+    '__int__': int,
+    '__float__': float,
+    '__index__': operator.index,
+    '__neg__': operator.neg,
+    '__pos__': operator.pos,
+    '__abs__': abs,
+    '__invert__': operator.invert,
+}
+
+_BINARY = {
+    '__eq__': operator.eq,
+    '__ne__': operator.ne,
+    '__lt__': operator.lt,
+    '__le__': operator.le,
+    '__gt__': operator.gt,
+    '__ge__': operator.ge,
+    '__add__': operator.add,
+    '__sub__': operator.sub,
+    '__mul__': operator.mul,
+    '__truediv__': operator.truediv,
+    '__floordiv__': operator.floordiv,
+    '__mod__': operator.mod,
+    '__pow__': operator.pow,
+    '__lshift__': operator.lshift,
+    '__rshift__': operator.rshift,
+    '__and__': operator.and_,
+    '__or__': operator.or_,
+    '__xor__': operator.xor,
+}
+
+
+def _forward_unary(function):
+    def method(self, *args):
+        object.__getattribute__(self, '_record').complete = False
+        return function(object.__getattribute__(self, '_target'), *args)
+
+    return method
+
+
+def _forward_binary(function, reflected=False):
+    def method(self, other):
+        object.__getattribute__(self, '_record').complete = False
+        target, other = object.__getattribute__(self, '_target'), _unwrap(other)
+
+        return function(other, target) if reflected else function(target, other)
+
+    return method
+
+
+def _refuse(name):
+    def method(self, *args):
+        raise MissingPath(object.__getattribute__(self, '_path') + (name,))
+
+    return method
+
+
+class RecordingProxy(object):
+    '''Wrap a parsed object recording the plain values reached through it.'''
+
+    def __init__(self, target, record: Record, path: Tuple = ()):
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_record', record)
+        object.__setattr__(self, '_path', path)
+
+    def _wrap(self, path, value):
+        if isinstance(value, FieldBase):
+            self._record.nodes.add(path)
+            return RecordingProxy(value, self._record, path)
+
+        plain = _plain(value)
+
+        if _is_plain(plain):
+            self._record.values[path] = plain
+        else:
+            logger.debug('value at %r can\'t be recorded', path)
+            self._record.complete = False
+
+        return value
+
+    def __getattr__(self, name):
+        return self._wrap(self._path + (name,), getattr(self._target, name))
+
+    def __getitem__(self, key):
+        if not _is_plain(key):  # it can't be stored as part of the path
+            self._record.complete = False
+            return self._target[_unwrap(key)]
+
+        return self._wrap(self._path + (('[]', key),), self._target[key])
+
+    def __len__(self):
+        return self._wrap(self._path + ('__len__',), len(self._target))
+
+    def __bool__(self):
+        return self._wrap(self._path + ('__bool__',), bool(self._target))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+for name, function in _UNARY.items():
+    setattr(RecordingProxy, name, _forward_unary(function))
+
+for name, function in _BINARY.items():
+    setattr(RecordingProxy, name, _forward_binary(function))
+
+    if name[2:4] not in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):  # the comparisons are reflected by python itself
+        setattr(RecordingProxy, '__r' + name[2:], _forward_binary(function, reflected=True))
+
+
+class ReplayProxy(object):
+    '''Stand in for a parsed object using the values of a Record.'''
+
+    def __init__(self, record: Record, path: Tuple = ()):
+        object.__setattr__(self, '_record', record)
+        object.__setattr__(self, '_path', path)
+
+    def _lookup(self, path):
+        try:
+            return self._record.values[path]
+        except KeyError:
+            pass
+
+        if path in self._record.nodes:
+            return ReplayProxy(self._record, path)
+
+        raise MissingPath(path)
+
+    def __getattr__(self, name):
+        return self._lookup(self._path + (name,))
+
+    def __getitem__(self, key):
+        return self._lookup(self._path + (('[]', key),))
+
+    def __len__(self):
+        return self._lookup(self._path + ('__len__',))
+
+    def __bool__(self):
+        return self._lookup(self._path + ('__bool__',))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+for name in list(_UNARY) + list(_BINARY):
+    setattr(ReplayProxy, name, _refuse(name))
+
+    if name in _BINARY and name[2:4] not in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+        setattr(ReplayProxy, '__r' + name[2:], _refuse('__r' + name[2:]))
+
+
+class ScanIndex(object):
+    '''The records of the files already parsed, stored in a sqlite database at path.'''
+
+    SCHEMA = '''CREATE TABLE IF NOT EXISTS files (
+        path   TEXT NOT NULL,
+        format TEXT NOT NULL,
+        size   INTEGER NOT NULL,
+        mtime  INTEGER NOT NULL,
+        record BLOB,
+        PRIMARY KEY (path, format)
+    )'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')  # the readers don't block the writer
+        self.connection.execute(self.SCHEMA)
+        self.connection.commit()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({self.path})>'
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def stat(path: str) -> Tuple[int, int]:
+        '''Return what identifies the version of the file at path.'''
+        st = os.stat(path)
+
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, path: str, format: str, stat: Optional[Tuple[int, int]] = None) -> Optional[Record]:
+        '''Return the record for the file, None if it's not of the given format;
+        raise KeyError if the file is not indexed, it has changed or its
+        record can't be decoded.'''
+        size, mtime = stat if stat is not None else self.stat(path)
+
+        row = self.connection.execute(
+            'SELECT record FROM files WHERE path = ? AND format = ? AND size = ? AND mtime = ?',
+            (path, format, size, mtime),
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(path)
+
+        if row[0] is None:
+            return None
+
+        try:
+            return Record.loads(row[0])
+        except ValueError as e:
+            logger.warning('invalid record for \'%s\': %s', path, e)
+            raise KeyError(path)
+
+    def put(self, path: str, format: str, record: Optional[Record], stat: Optional[Tuple[int, int]] = None, commit: bool = True):
+        size, mtime = stat if stat is not None else self.stat(path)
+
+        self.connection.execute(
+            'INSERT OR REPLACE INTO files (path, format, size, mtime, record) VALUES (?, ?, ?, ?, ?)',
+            (path, format, size, mtime, record.dumps() if record is not None else None),
+        )
+
+        if commit:
+            self.connection.commit()
+
+    def put_many(self, entries: Iterable[Tuple[str, str, Optional[Record], Tuple[int, int]]]):
+        for path, format, record, stat in entries:
+            self.put(path, format, record, stat=stat, commit=False)
+
+        self.connection.commit()
@@ -0,0 +1,477 @@
+'''
+Compiled un/packing plans for Chunk classes.
+
+Un/packing a Chunk field by field means a read() (or write()) and a struct
+call for each StructField, so a chunk like the ELF section header costs
+a dozen of them. Here we group the runs of adjacent fixed-size StructFields
+so that each run can be handled with a single read and a single precompiled
+struct.Struct.
+
+The grouping depends only on the class of the chunk and on the order of its
+fields, so it's computed once and stored in the chunk's Meta; the actual
+format of a run (the endianess and the word size can depend on other fields,
+think of EI_DATA and EI_CLASS for the ELF format) is resolved at runtime and
+the corresponding struct.Struct is cached per variant.
+
+In the same way, from the fields with is_magic=True at a position known
+statically we derive the MagicPrefix of a Chunk class, that allows to reject
+the data not in the right format before building any field.
+
+Finally has_fixed_size() tells if all the instances created from a prototype
+have the same size, so that an ArrayField of them can compute its size and
+the position of its elements without unpacking them.
+'''
+import logging
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from .fields import Field, FieldDescriptor, StructField, StringField
+from .properties import ChunkPhase, Dependency, FieldPath
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_prototype(chunk_cls, name: str) -> Optional[Field]:
+    '''Return the field instance used as prototype for the field named "name".'''
+    for klass in chunk_cls.__mro__:
+        descriptor = klass.__dict__.get(name)
+        if isinstance(descriptor, FieldDescriptor):
+            return descriptor.field
+
+    return None
+
+
+def _has_static_offset(field: Field) -> bool:
+    # we look directly into the instance to avoid resolving a Dependency
+    return field.__dict__.get('_Field__offset') is None
+
+
+def is_unpack_candidate(field: Field) -> bool:
+    return (
+        isinstance(field, StructField)
+        and type(field).unpack is StructField.unpack
+        and _has_static_offset(field)
+    )
+
+
+def is_pack_candidate(field: Field) -> bool:
+    return (
+        isinstance(field, StructField)
+        and type(field).pack is StructField.pack
+        and type(field)._update_value is Field._update_value
+        and _has_static_offset(field)
+    )
+
+
+def _has_known_format(field: Field) -> bool:
+    '''The format of a field overriding get_format() can depend on anything,
+    like a sibling decoded just before it, unless it declares that it uses
+    only its dependencies (see StructField.format_from_dependencies).'''
+    cls = type(field)
+
+    return cls.get_format is StructField.get_format or cls.format_from_dependencies
+
+
+def _depends_on(chunk_cls, field: Field, names: List[str]) -> bool:
+    '''Return True if a dependency of field (its endianess for example) can be
+    resolved to one of the fields named names of a chunk of class chunk_cls:
+    their values would be needed before being decoded.'''
+    classes = [_.__name__ for _ in chunk_cls.__mro__]
+
+    for dependency in field.__dict__.get('_dependencies', {}).values():
+        path = dependency.path
+
+        # from the root it's the same if the chunk is the root itself
+        if path.origin == FieldPath.CLASS and path.class_name not in classes:
+            continue
+
+        if path.components and path.components[0] in names:
+            return True
+
+    return False
+
+
+def _has_external_dependencies(chunk_cls, field: Field) -> bool:
+    '''Return True if field has dependencies starting from the root or from an
+    ancestor of a chunk of class chunk_cls: when the chunk is nested they can
+    come back into it, and that is known only at runtime (see StructRun.unpack()).'''
+    classes = [_.__name__ for _ in chunk_cls.__mro__]
+
+    for dependency in field.__dict__.get('_dependencies', {}).values():
+        path = dependency.path
+
+        if path.origin == FieldPath.ROOT:
+            return True
+
+        if path.origin == FieldPath.CLASS and path.class_name not in classes:
+            return True
+
+    return False
+
+
+def _same_endianess(a: Field, b: Field) -> bool:
+    '''It returns False only when we know for sure that the two fields
+    have different endianess, otherwise the check is postponed at runtime:
+    a run whose formats have different prefixes is not used (see StructRun._build()).
+    An endianess resolved from a field of the same run is excluded by _depends_on().'''
+    endianess_a = a.__dict__.get('endianess')
+    endianess_b = b.__dict__.get('endianess')
+
+    if isinstance(endianess_a, Dependency) or isinstance(endianess_b, Dependency):
+        return True
+
+    return endianess_a == endianess_b
+
+
+class StructRun(object):
+    '''A sequence of adjacent StructFields un/packed with a single struct.Struct.'''
+
+    STANDARD_PREFIXES = '<>!='
+
+    def __init__(self, start: int, names: Tuple[str, ...], checked: Tuple[int, ...] = ()):
+        self.start = start
+        self.names = names
+        self.checked = checked  # the positions of the fields with external dependencies
+        self._structs: Dict[Tuple[str, ...], Optional[Tuple[struct.Struct, List[Tuple[int, int]]]]] = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({",".join(self.names)})>'
+
+    @classmethod
+    def _build(cls, formats: Tuple[str, ...]) -> Optional[Tuple[struct.Struct, List[Tuple[int, int]]]]:
+        prefix = formats[0][:1]
+
+        if prefix not in cls.STANDARD_PREFIXES:
+            return None
+
+        boundaries = []
+        offset = 0
+        for fmt in formats:
+            # with the native alignment the concatenation doesn't behave like
+            # the single formats, moreover each field must decode exactly one value
+            if fmt[:1] != prefix:
+                return None
+            size = struct.calcsize(fmt)
+            if len(struct.unpack(fmt, bytes(size))) != 1:
+                return None
+
+            boundaries.append((offset, offset + size))
+            offset += size
+
+        return struct.Struct(prefix + ''.join([_[1:] for _ in formats])), boundaries
+
+    def compile(self, fields: List[Tuple[str, Field]]) -> Optional[Tuple[struct.Struct, List[Tuple[int, int]]]]:
+        '''Return the struct.Struct and the boundaries of each field for the
+        actual formats of the fields, None if the run can't be merged.'''
+        formats = tuple([_.get_format() for __, _ in fields])
+
+        try:
+            return self._structs[formats]
+        except KeyError:
+            pass
+
+        compiled = self._build(formats)
+        self._structs[formats] = compiled
+
+        logger.debug('compiled run %r with formats %r', self, formats)
+
+        return compiled
+
+    def unpack(self, fields: List[Tuple[str, Field]], stream) -> Optional[List[Tuple[bytes, object]]]:
+        '''Read the data for all the fields in one go and return a list of
+        couples (raw data, value), one for each field.
+
+        If the run cannot be used (e.g. there isn't enough data) None is returned
+        and the stream is left untouched.'''
+        if self.checked and self._resolves_into(fields):
+            return None
+
+        compiled = self.compile(fields)
+
+        if compiled is None:
+            return None
+
+        layout, boundaries = compiled
+
+        start = stream.tell()
+        data = stream.read(layout.size)
+
+        if len(data) != layout.size:
+            stream.seek(start)
+            return None
+
+        values = layout.unpack_from(data)
+
+        return [(data[begin:end], value) for (begin, end), value in zip(boundaries, values)]
+
+    def _resolves_into(self, fields: List[Tuple[str, Field]]) -> bool:
+        '''Return True if a dependency of a field of the run is resolved to a
+        field preceding it in the same run, whose value is not decoded yet.'''
+        for idx in self.checked:
+            field = fields[idx][1]
+            preceding = [_ for __, _ in fields[:idx]]
+
+            for dependency in field.__dict__['_dependencies'].values():
+                try:
+                    target = dependency.resolve_field(field)
+                except AttributeError:  # let the fields resolve it one by one
+                    return True
+
+                target = getattr(target, '__self__', target)  # a bound method
+
+                if any([target is _ for _ in preceding]):
+                    return True
+
+        return False
+
+    def pack(self, fields: List[Tuple[str, Field]], stream) -> bool:
+        '''Write all the fields in one go, it returns False if the run cannot be used
+        (e.g. the offsets of the fields are not contiguous).'''
+        compiled = self.compile(fields)
+
+        if compiled is None:
+            return False
+
+        layout, boundaries = compiled
+
+        start = fields[0][1].offset
+
+        if start is None:
+            return False
+
+        for (_, field), (begin, _end) in zip(fields, boundaries):
+            if field.offset != start + begin:
+                return False
+
+        values = [field.get_raw_value() for _, field in fields]
+
+        stream.seek(start)
+        data = stream.write_packed(layout, *values)
+
+        for (_, field), (begin, end) in zip(fields, boundaries):
+            field._data = data[begin:end] if data is not None else None
+            field._phase = ChunkPhase.DONE
+
+        return True
+
+
+class ChunkPlan(object):
+    '''The runs for a given Chunk class with a given order of its fields.'''
+
+    def __init__(self, chunk_cls, names: Tuple[str, ...]):
+        self.names = names
+        self.unpack_runs = self._find_runs(chunk_cls, names, is_unpack_candidate)
+        self.pack_runs = self._find_runs(chunk_cls, names, is_pack_candidate)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}(unpack={list(self.unpack_runs.values())!r}, pack={list(self.pack_runs.values())!r})>'
+
+    @staticmethod
+    def _find_runs(chunk_cls, names, is_candidate) -> Dict[int, StructRun]:
+        runs = {}
+        current: List[int] = []
+        prototypes = [get_prototype(chunk_cls, _) for _ in names]
+
+        def close():
+            if len(current) > 1:
+                checked = tuple([
+                    position for position, _ in enumerate(current)
+                    if position and _has_external_dependencies(chunk_cls, prototypes[_])
+                ])
+                runs[current[0]] = StructRun(current[0], tuple([names[_] for _ in current]), checked=checked)
+            current.clear()
+
+        for idx, prototype in enumerate(prototypes):
+            if prototype is None or not is_candidate(prototype):
+                close()
+                continue
+
+            # the formats of a run are computed before decoding any of its fields
+            if current and (
+                not _same_endianess(prototypes[current[-1]], prototype)
+                or not _has_known_format(prototype)
+                or _depends_on(chunk_cls, prototype, [names[_] for _ in current])
+            ):
+                close()
+
+            current.append(idx)
+
+        close()
+
+        return runs
+
+    @classmethod
+    def for_chunk(cls, chunk, fields: List[Tuple[str, Field]]) -> 'ChunkPlan':
+        names = tuple([_ for _, __ in fields])
+        plans = chunk._meta.plans
+
+        try:
+            return plans[names]
+        except KeyError:
+            pass
+
+        plan = cls(chunk.__class__, names)
+        plans[names] = plan
+
+        logger.debug('compiled plan for %s: %r', chunk.__class__.__name__, plan)
+
+        return plan
+
+
+class MagicPrefix(object):
+    '''The bytes that must be present at given offsets for the data to be
+    unpacked by a Chunk class (i.e. the values of its magic fields).'''
+
+    _cache: Dict[type, Optional['MagicPrefix']] = {}
+
+    def __init__(self, patterns: List[Tuple[int, bytes]]):
+        # merge the adjacent ones (think of the four EI_MAG* of the ELF format)
+        self.patterns: List[Tuple[int, bytes]] = []
+        for offset, pattern in sorted(patterns):
+            if self.patterns:
+                last_offset, last_pattern = self.patterns[-1]
+
+                if last_offset + len(last_pattern) == offset:
+                    self.patterns[-1] = (last_offset, last_pattern + pattern)
+                    continue
+
+            self.patterns.append((offset, pattern))
+
+        self.size = max([offset + len(_) for offset, _ in patterns])
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({self.patterns!r})>'
+
+    def match(self, data: bytes) -> bool:
+        return all([data[offset:offset + len(_)] == _ for offset, _ in self.patterns])
+
+    @staticmethod
+    def _is_static(field: Field, *names) -> bool:
+        return not any([isinstance(field.__dict__.get(_), Dependency) for _ in names])
+
+    @classmethod
+    def _collect(cls, chunk_cls, position: int, patterns: List[Tuple[int, bytes]]) -> Optional[int]:
+        '''Append the patterns of the magic fields of chunk_cls starting at position
+        and return where the chunk ends, None if from some point on the layout
+        is known only at runtime.'''
+        for name in chunk_cls._meta.fields:
+            prototype = get_prototype(chunk_cls, name)
+
+            if prototype is None or not cls._is_static(prototype, '_Field__offset'):
+                return None
+
+            offset = prototype.__dict__.get('_Field__offset')
+            position = offset if offset is not None else position
+
+            if hasattr(type(prototype), '_meta'):  # a sub-chunk
+                position = cls._collect(type(prototype), position, patterns)
+
+                if position is None:
+                    return None
+            elif (isinstance(prototype, StructField)
+                    and type(prototype).unpack is StructField.unpack
+                    and type(prototype).get_format is StructField.get_format
+                    and cls._is_static(prototype, 'format', 'endianess')):
+                fmt = prototype.get_format()
+
+                if prototype.is_magic:
+                    default = prototype.__dict__['default']
+                    patterns.append((position, struct.pack(fmt, default if not prototype.enum else default.value)))
+
+                position += struct.calcsize(fmt)
+            elif (isinstance(prototype, StringField)
+                    and type(prototype).unpack is StringField.unpack
+                    and isinstance(prototype.__dict__.get('_n'), int)):
+                if prototype.is_magic:
+                    patterns.append((position, bytes(prototype.__dict__['default'])))
+
+                position += prototype.__dict__['_n']
+            else:
+                return None
+
+        return position
+
+    @classmethod
+    def for_class(cls, chunk_cls) -> Optional['MagicPrefix']:
+        '''Return the MagicPrefix for chunk_cls, None if it has no magic
+        fields at a static position.'''
+        try:
+            return cls._cache[chunk_cls]
+        except KeyError:
+            pass
+
+        patterns: List[Tuple[int, bytes]] = []
+        cls._collect(chunk_cls, 0, patterns)
+
+        prefix = cls(patterns) if patterns else None
+        cls._cache[chunk_cls] = prefix
+
+        logger.debug('magic prefix for %s: %r', chunk_cls.__name__, prefix)
+
+        return prefix
+
+
+_fixed_size_cache: Dict[type, bool] = {}
+
+
+def _has_shared_dependencies(field: Field, inner: Tuple[str, ...]) -> bool:
+    '''The dependencies resolved from the root (like the class of an ELF) or
+    from an ancestor outside of the element (inner are the class names of the
+    chunks from the element to the field) have the same value for all the
+    elements of an array.'''
+    for dependency in field.__dict__.get('_dependencies', {}).values():
+        path = dependency.path
+
+        if path.origin == FieldPath.ROOT:
+            continue
+
+        if path.origin == FieldPath.CLASS and path.class_name not in inner:
+            continue
+
+        return False
+
+    return True
+
+
+def has_fixed_size(prototype: Field, inner: Tuple[str, ...] = ()) -> bool:
+    '''Return True if the size of the fields created from prototype doesn't
+    depend on their data, i.e. they are made only of StructFields and StringFields
+    of a given length, with no explicit offsets.'''
+    chunk_cls = type(prototype)
+
+    if hasattr(chunk_cls, '_meta'):  # a sub-chunk
+        from .core import Chunk  # core imports this module
+
+        # the result for the whole element doesn't change so we can cache it
+        if not inner and chunk_cls in _fixed_size_cache:
+            return _fixed_size_cache[chunk_cls]
+
+        inner = inner + (chunk_cls.__name__,)
+        fixed = chunk_cls.size is Chunk.size and _has_shared_dependencies(prototype, inner)
+
+        for name in chunk_cls._meta.fields if fixed else []:
+            field = get_prototype(chunk_cls, name)
+
+            if field is None or not _has_static_offset(field) or not has_fixed_size(field, inner):
+                fixed = False
+                break
+
+        if len(inner) == 1:
+            _fixed_size_cache[chunk_cls] = fixed
+
+        return fixed
+
+    if not _has_shared_dependencies(prototype, inner):
+        return False
+
+    if isinstance(prototype, StructField):
+        return chunk_cls.size is StructField.size and _has_known_format(prototype)
+
+    if isinstance(prototype, StringField):
+        return chunk_cls.size is StringField.size and isinstance(prototype.__dict__.get('_n'), int)
+
+    return False
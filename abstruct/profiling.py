@@ -0,0 +1,185 @@
+'''
+Instrumentation of unpack() and pack().
+
+The hooks registered with add_hook() are called with an Event for each field
+unpacked or packed by a Chunk; when no hook is registered the only cost is
+checking that the list is empty. The most common hook is a Profile that
+aggregates the events by path of the field and class
+
+    >>> with abstruct.profile() as stats:
+    ...     ElfFile('/bin/ls')
+    >>> print(stats.report(limit=10))
+
+Times and bytes are inclusive of the sub-fields, the fields unpacked with a
+single read (see plan.StructRun) share the time of the read in proportion
+to their size.
+'''
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+hooks = []  # the callables receiving the events, see add_hook()
+
+
+class Event(NamedTuple):
+    operation: str  # "unpack" or "pack"
+    field: object
+    seconds: float
+    bytes_read: int
+    seeks: int
+
+
+def add_hook(hook: Callable[[Event], None]):
+    hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[Event], None]):
+    hooks.remove(hook)
+
+
+def emit(event: Event):
+    for hook in list(hooks):
+        hook(event)
+
+
+@contextmanager
+def counting(stream):
+    '''Count the operations done on the stream in the block, the counters
+    are created if missing (a stream doesn't count anything if nobody asks)
+    and removed at the end so the stream doesn't pay for them afterwards.'''
+    previous = stream.stats
+    if previous is None:
+        from .streams import StreamStats
+        stream.stats = StreamStats()
+
+    try:
+        yield stream.stats
+    finally:
+        stream.stats = previous
+
+
+@contextmanager
+def measure(operation: str, field, stream):
+    '''Emit an event for the operation done on the field in the block.'''
+    with counting(stream) as stats:
+        bytes_read, seeks = stats.bytes_read, stats.seeks
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            emit(Event(operation, field, time.perf_counter() - start, stats.bytes_read - bytes_read, stats.seeks - seeks))
+
+
+def emit_run(operation: str, fields: Iterable, sizes: Iterable[int], seconds: float, seeks: int):
+    '''Emit an event for each field done together, splitting the time by size.'''
+    sizes = list(sizes)
+    total = sum(sizes) or 1
+
+    for idx, (field, size) in enumerate(zip(fields, sizes)):
+        emit(Event(operation, field, seconds * size / total, size if operation == 'unpack' else 0, seeks if idx == 0 else 0))
+
+
+def field_path(field) -> str:
+    '''Return a path like "ElfFile.header.e_ident", the elements of a container
+    (that have no name) are indicated with "[]".'''
+    names = []
+
+    while field.father is not None:
+        names.append(field.name if field.name is not None else '[]')
+        field = field.father
+
+    names.append(field.__class__.__name__)
+
+    return '.'.join(reversed(names))
+
+
+class FieldStats(object):
+    __slots__ = ('calls', 'unpack_time', 'pack_time', 'bytes_read', 'seeks')
+
+    def __init__(self):
+        self.calls = 0
+        self.unpack_time = 0.0
+        self.pack_time = 0.0
+        self.bytes_read = 0
+        self.seeks = 0
+
+    def __repr__(self):
+        return (
+            f'<{self.__class__.__name__}(calls={self.calls}, unpack_time={self.unpack_time:.6f}, '
+            f'pack_time={self.pack_time:.6f}, bytes_read={self.bytes_read}, seeks={self.seeks})>'
+        )
+
+    def add(self, other: 'FieldStats'):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    @property
+    def time(self) -> float:
+        return self.unpack_time + self.pack_time
+
+
+class Profile(object):
+    '''Hook aggregating the events by (path, class name) of the field.'''
+
+    def __init__(self):
+        self.stats: Dict[Tuple[str, str], FieldStats] = {}
+        self._lock = threading.Lock()  # the sections of an ELF can be unpacked by more threads
+
+    def __call__(self, event: Event):
+        key = (field_path(event.field), event.field.__class__.__name__)
+
+        with self._lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = FieldStats()
+
+            stats.calls += 1
+            if event.operation == 'unpack':
+                stats.unpack_time += event.seconds
+            else:
+                stats.pack_time += event.seconds
+            stats.bytes_read += event.bytes_read
+            stats.seeks += event.seeks
+
+    def __enter__(self):
+        add_hook(self)
+
+        return self
+
+    def __exit__(self, *args):
+        remove_hook(self)
+
+    def by_class(self) -> Dict[str, FieldStats]:
+        '''The stats summed over all the paths of the same class.'''
+        classes = {}
+
+        for (_, class_name), stats in self.stats.items():
+            classes.setdefault(class_name, FieldStats()).add(stats)
+
+        return classes
+
+    def report(self, limit: Optional[int] = None) -> str:
+        '''A table with the paths that took more time first.'''
+        rows = sorted(self.stats.items(), key=lambda _: _[1].time, reverse=True)[:limit]
+
+        lines = [f'{"path":60s} {"class":24s} {"calls":>8s} {"unpack ms":>10s} {"pack ms":>10s} {"bytes":>10s} {"seeks":>8s}']
+        for (path, class_name), stats in rows:
+            lines.append(
+                f'{path:60s} {class_name:24s} {stats.calls:8d} {stats.unpack_time * 1000:10.3f} '
+                f'{stats.pack_time * 1000:10.3f} {stats.bytes_read:10d} {stats.seeks:8d}'
+            )
+
+        return '\n'.join(lines)
+
+
+def profile() -> Profile:
+    '''Return a Profile to use as context manager, the events of the
+    unpack()/pack() done in the block are aggregated into it.'''
+    return Profile()
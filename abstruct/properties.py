@@ -1,5 +1,9 @@
 import logging
 from enum import Enum
+from types import MethodType
+
+
+logger = logging.getLogger(__name__)
 
 
 class ChunkPhase(Enum):
@@ -31,6 +35,92 @@ def get_instance_from_chunk(instance, condition):
     return father
 
 
+# it's incremented every time the structure of a tree changes (a field
+# replaced or moved under another father) so that the fields resolved
+# by the dependencies are looked up again
+_generation = 0
+
+
+def invalidate_dependencies():
+    global _generation
+    _generation += 1
+
+    invalidate_sizes()
+
+
+# the sizes cached by the fields are valid only for the same epoch: it's
+# incremented when a field used by a dependency is written since it could
+# determine the size of any other field in the tree (a length for example)
+_size_epoch = 0
+
+
+def invalidate_sizes():
+    global _size_epoch
+    _size_epoch += 1
+
+
+class FieldPath(object):
+    '''The compiled form of a dependency's expression, like python modules
+    the components are separated by dots:
+
+     - "a.b" starts from the root
+     - ".a.b" starts from the father
+     - "@ClassName.a.b" starts from the first ancestor with the given class name
+
+    The expressions are compiled once and shared.'''
+    ROOT   = 'root'
+    FATHER = 'father'
+    CLASS  = 'class'
+
+    _compiled = {}
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.class_name = None
+
+        components = expression.split('.')
+
+        if components[0] != '':
+            if components[0].startswith('@'):  # we want to resolve wrt a class
+                self.origin = self.CLASS
+                self.class_name = components[0][1:]
+                components = components[1:]  # skip the first one that is already resolved
+            else:
+                self.origin = self.ROOT
+        else:  # we have a relative dependency
+            self.origin = self.FATHER
+            components = components[1:]  # skip the first one that is empty
+
+        self.components = tuple(components)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({self.expression})>'
+
+    @classmethod
+    def compile(cls, expression):
+        try:
+            return cls._compiled[expression]
+        except KeyError:
+            path = cls(expression)
+            cls._compiled[expression] = path
+
+            return path
+
+    def resolve(self, instance):
+        if self.origin == self.CLASS:
+            field = get_instance_from_class_name(instance, self.class_name)
+        elif self.origin == self.ROOT:
+            field = get_root_from_chunk(instance)
+        else:
+            field = instance.father
+
+        # now we can resolve each component
+        for component_name in self.components:
+            field = getattr(field, component_name)
+
+        return field
+
+
 class Dependency(object):
     '''This makes the relation between fields possible.
 
@@ -41,64 +131,72 @@ class Dependency(object):
 
     Probably right now is overcomplicated, we want to understand if make sense
     to use __getattribute__ and __setattr__ to resolve automagically.
+
+    The field found is cached in the instance that resolves the dependency
+    (until the structure of the tree changes, see invalidate_dependencies()) and
+    so is its value, until the field is written.
     '''
 
     def __init__(self, expression, obj=None):
         self.expression = expression
+        self.path = FieldPath.compile(expression)
         self.obj = obj
-        self.logger = logging.getLogger(__name__)
+        self.logger = logger
 
     def __call__(self, obj):
         return Dependency(self.expression, obj=obj)
 
-    def resolve_field(self, instance):
-        self.logger.debug('trying to resolve \'%s\'' % self.expression)
-        field = None
-        # here split the expression into the components
-        # like python modules
-        fields_path = self.expression.split('.')  # FIXME: create class FieldPath to encapsulate
-
-        # find the root the resolution starts
-        if fields_path[0] != '':
-            if fields_path[0].startswith('@'):  # we want to resolve wrt a class
-                class_name = fields_path[0][1:]
-                self.logger.debug('resolve from class name: \'%s\'' % class_name)
-                field = get_instance_from_class_name(instance, class_name)
-
-                fields_path = fields_path[1:]  # skip the first one that is already resolved
-            else:
-                field = get_root_from_chunk(instance)
-                self.logger.debug('resolve from root: \'%s\'' % field.__class__.__name__)
-        else:  # we have a relative dependency
-            field = instance.father
-            self.logger.debug('resolve from father: \'%s\'' % field.__class__.__name__)
-            fields_path = fields_path[1:]  # skip the first one that is empty
+    def _get_cache_entry(self, instance):
+        cache = instance.__dict__.setdefault('_dependency_cache', {})
+        entry = cache.get(self)
 
-        # now we can resolve each component
-        for component_name in fields_path:
-            field = getattr(field, component_name)
-        self.logger.debug('resolved as field %s' % field.__class__.__name__)
+        if entry is None or entry[0] != _generation:
+            self.logger.debug('trying to resolve \'%s\'', self.expression)
+            # [generation, field, version of the field, value]
+            entry = [_generation, self.path.resolve(instance), None, None]
+            cache[self] = entry
 
-        return field
+            # writing it must invalidate the cached sizes
+            if not isinstance(entry[1], MethodType) and hasattr(entry[1], '__dict__'):
+                entry[1].__dict__['_dependency_target'] = True
+            self.logger.debug('resolved as field %s', entry[1].__class__.__name__)
+
+        return entry
+
+    def resolve_field(self, instance):
+        return self._get_cache_entry(instance)[1]
 
     def resolve(self, instance):
         '''With this method we resolve the attribute with respect to the instance
         passed as argument.'''
-        field = self.resolve_field(instance)
+        entry = self._get_cache_entry(instance)
+        field = entry[1]
 
-        import inspect
+        if isinstance(field, MethodType):
+            return field()
 
-        value = None
+        version = field.__dict__.get('_version')
 
-        if inspect.ismethod(field):
-            value = field()
-        else:
-            value = field.value
+        if version is not None and entry[2] == version:
+            return entry[3]
+
+        value = field.value
+
+        # a value computed by a custom getter can change without the field
+        # being written so we can't cache it
+        if getattr(type(field), 'stored_value', False):
+            entry[2] = field.__dict__.get('_version')
+            entry[3] = value
 
-        self.logger.debug('resolved with value %s' % value)
+        self.logger.debug('resolved with value %s', value)
 
         return value
 
+    def inverse(self, value):
+        '''Return the value to write into the field this depends on
+        so that it resolves to value.'''
+        return value
+
 
 class RatioDependency(Dependency):
 
@@ -111,6 +209,9 @@ class RatioDependency(Dependency):
 
         return int(value / self._ratio)
 
+    def inverse(self, value):
+        return value * self._ratio
+
 
 # NOTE: we need the caller to seek() correctly a given offset
 #       if it depends on external fields
@@ -0,0 +1,408 @@
+'''
+Scanning engine: find the files that, once parsed with a given Chunk
+subclass, satisfy a condition (this is what scripts/find.py is built on).
+
+The files are parsed by a pool of processes, the paths are sent to them in
+batches and only a bounded number of batches is in flight at any time, so
+that walking a huge tree doesn't fill the memory with pending work; the
+matches are yielded as soon as they are found.
+
+Before parsing a file its first bytes are compared with the magic of the
+format (see abstruct.plan.MagicPrefix) so that most of the files are
+rejected without building any Chunk.
+
+The condition is analyzed to find which fields of the object it uses, if
+possible only those fields are unpacked (see Chunk.probe()).
+
+With an index (see abstruct.index.ScanIndex) the condition is evaluated on
+the values recorded the last time the file was parsed, if the file hasn't
+changed since then and the values needed are all there.
+'''
+import ast
+import importlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .enum import Compliant
+from .exceptions import MagicException, ChunkUnpackException
+from .index import MissingPath, Record, RecordingProxy, ReplayProxy, ScanIndex
+from .plan import MagicPrefix
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_file(cls, path, fields: Optional[List[str]] = None, ignore_errors: bool = True):
+    '''Return the instance of cls parsed from path, None if the file is not
+    of the given format.
+
+    If fields is not None only the fields at the given paths (and the ones they
+    depend on) are unpacked, see Chunk.probe(). If ignore_errors is False an
+    OSError is raised instead of returning None.'''
+    try:
+        if fields is None:
+            victim = cls(path, compliant=Compliant.MAGIC)
+        else:
+            victim = cls.probe(path, fields=fields, compliant=Compliant.MAGIC)
+    except (MagicException, ChunkUnpackException):
+        return None
+    except OSError:
+        if not ignore_errors:
+            raise
+        return None
+    except Exception:
+        logger.error('failed to handle file at path \'%s\'', path, exc_info=True)
+        return None
+
+    return victim
+
+
+def condition_paths(condition: str, name: str = 'obj') -> Optional[List[Tuple[str, ...]]]:
+    '''Return the chains of attributes accessed starting from the variable
+    called name in the condition, e.g. [("header", "e_machine", "value")];
+    None if the variable is used in some other way (passed to a function,
+    subscripted, etc...) and so we can't know which fields are needed.'''
+    tree = ast.parse(condition, mode='eval')
+    parents = {}
+
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+
+    paths = []
+    names = [_ for _ in ast.walk(tree) if isinstance(_, ast.Name) and _.id == name]
+
+    for node in sorted(names, key=lambda _: (_.lineno, _.col_offset)):
+        if not isinstance(node.ctx, ast.Load):
+            return None
+
+        path = []
+        parent = parents.get(node)
+
+        while isinstance(parent, ast.Attribute) and parent.value is node:
+            path.append(parent.attr)
+            node, parent = parent, parents.get(parent)
+
+        if not path:
+            return None
+
+        if tuple(path) not in paths:
+            paths.append(tuple(path))
+
+    return paths
+
+
+def has_magic(prefix: Optional[MagicPrefix], path: str, ignore_errors: bool = True) -> bool:
+    '''Check with a single small read if the file can be of the format
+    having the given MagicPrefix, see parse_file() for ignore_errors.'''
+    if prefix is None:
+        return True
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(prefix.size)
+    except OSError:
+        if not ignore_errors:
+            raise
+        return False
+
+    return prefix.match(data)
+
+
+def iter_paths(basepaths: Iterable[str], max_depth: Optional[int] = None) -> Iterator[str]:
+    '''Yield the paths of the regular files under basepaths, like find(1)
+    the depth of basepath itself is zero. Symbolic links to directories
+    are not followed.'''
+    for basepath in basepaths:
+        if not os.path.isdir(basepath):
+            if os.path.isfile(basepath):
+                yield os.path.realpath(basepath)
+            continue
+
+        base_depth = basepath.rstrip(os.sep).count(os.sep)
+
+        for dirpath, dirnames, filenames in os.walk(basepath):
+            depth = dirpath.rstrip(os.sep).count(os.sep) - base_depth
+
+            if max_depth is not None and depth + 1 >= max_depth:
+                dirnames.clear()  # don't descend further
+
+                if depth + 1 > max_depth:
+                    continue
+
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+
+                if not os.path.isfile(path):
+                    continue
+
+                yield os.path.realpath(path)  # FIXME: in this way resolve symlinks and could be a problem
+
+
+class Query(object):
+    '''What we are looking for: the files parsed by the class named class_name
+    inside the module named namespace for which condition is true.
+
+    The condition is a python expression that can use the module as "ns" and
+    the parsed object as "obj". It's compiled once for each process.'''
+
+    _compiled = {}
+    _paths = {}
+
+    def __init__(self, namespace: str, class_name: str, condition: str):
+        self.namespace = namespace
+        self.class_name = class_name
+        self.condition = condition
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({self.namespace}.{self.class_name}, {self.condition!r})>'
+
+    @property
+    def ns(self):
+        return importlib.import_module(self.namespace)
+
+    @property
+    def cls(self):
+        return getattr(self.ns, self.class_name)
+
+    @property
+    def code(self):
+        try:
+            return self._compiled[self.condition]
+        except KeyError:
+            code = compile(self.condition, '<condition>', 'eval')
+            self._compiled[self.condition] = code
+
+            return code
+
+    @property
+    def fields(self) -> Optional[List[str]]:
+        '''The paths of the fields of the object needed by the condition,
+        None if the whole object must be unpacked.'''
+        key = (self.format, self.condition)
+
+        try:
+            return self._paths[key]
+        except KeyError:
+            pass
+
+        paths = condition_paths(self.condition)
+        fields: Optional[List[str]] = None
+
+        if paths is not None:
+            fields = []
+            for path in paths:
+                # methods and properties of the object can access anything
+                if path[0] not in self.cls._meta.fields:
+                    fields = None
+                    break
+
+                fields.append('.'.join(path))
+
+        logger.debug('fields needed by %r: %r', self.condition, fields)
+        self._paths[key] = fields
+
+        return fields
+
+    def parse(self, path: str, ignore_errors: bool = True):
+        return parse_file(self.cls, path, fields=self.fields, ignore_errors=ignore_errors)
+
+    def evaluate(self, obj) -> bool:
+        return bool(eval(self.code, {'ns': self.ns, 'obj': obj}))
+
+    @property
+    def format(self) -> str:
+        '''The key used for the format in the ScanIndex.'''
+        return f'{self.namespace}.{self.class_name}'
+
+    @property
+    def magic(self) -> Optional[MagicPrefix]:
+        return MagicPrefix.for_class(self.cls)
+
+    def _evaluate_safe(self, obj, path) -> Optional[bool]:
+        try:
+            return self.evaluate(obj)
+        except MissingPath:
+            raise
+        except Exception:
+            logger.error('failed to evaluate the condition for file at path \'%s\'', path, exc_info=True)
+            return None
+
+    def match(self, path: str) -> bool:
+        if not has_magic(self.magic, path):
+            return False
+
+        obj = self.parse(path)
+
+        if obj is None:
+            return False
+
+        return bool(self._evaluate_safe(obj, path))
+
+    def match_indexed(self, path: str, index: ScanIndex) -> Tuple[bool, Optional[tuple]]:
+        '''Like match() but using the index: it returns also the entry to put
+        into the index (see ScanIndex.put_many()), None if nothing changed.'''
+        try:
+            stat = index.stat(path)
+        except OSError:
+            return False, None
+
+        try:
+            record = index.get(path, self.format, stat=stat)
+        except KeyError:
+            record = Record()
+        else:
+            if record is None:  # not of this format
+                return False, None
+
+            try:
+                return bool(self._evaluate_safe(ReplayProxy(record), path)), None
+            except MissingPath as e:
+                logger.debug('%r not indexed for \'%s\'', e.args[0], path)
+
+        # a file that cannot be read now is not indexed, only one that is
+        # surely not of this format
+        try:
+            obj = self.parse(path, ignore_errors=False) if has_magic(self.magic, path, ignore_errors=False) else None
+        except OSError as e:
+            logger.debug('cannot read \'%s\': %s', path, e)
+            return False, None
+
+        if obj is None:
+            return False, (path, self.format, None, stat)
+
+        record.complete = True
+        result = self._evaluate_safe(RecordingProxy(obj, record), path)
+
+        if result is None or not record.complete:
+            return bool(result), None
+
+        return result, (path, self.format, record, stat)
+
+
+_indexes = {}
+
+
+def get_index(path: str) -> ScanIndex:
+    '''Return the ScanIndex at path opened by this process (a sqlite
+    connection must not be used after a fork()).'''
+    key = (os.getpid(), path)
+
+    try:
+        return _indexes[key]
+    except KeyError:
+        index = ScanIndex(path)
+        _indexes[key] = index
+
+        return index
+
+
+def scan_batch(query: Query, paths: List[str], index_path: Optional[str] = None) -> Tuple[List[str], List[tuple]]:
+    '''Return the paths matching the query and the entries to update in the index,
+    this is the unit of work of the processes.'''
+    if index_path is None:
+        return [_ for _ in paths if query.match(_)], []
+
+    index = get_index(index_path)
+    matches, entries = [], []
+
+    for path in paths:
+        matched, entry = query.match_indexed(path, index)
+
+        if matched:
+            matches.append(path)
+
+        if entry is not None:
+            entries.append(entry)
+
+    return matches, entries
+
+
+def _batches(paths: Iterable[str], size: int) -> Iterator[List[str]]:
+    batch = []
+
+    for path in paths:
+        batch.append(path)
+
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class Scanner(object):
+    '''Scan the files for the ones matching the query.
+
+    With workers set to zero everything is done in the calling process,
+    otherwise a pool of workers processes is used (None means one for CPU);
+    at most queue_size batches of batch_size paths are waiting to be processed.
+
+    If index is the path of a ScanIndex, it is used and updated (only by the
+    calling process) with the files parsed.'''
+
+    def __init__(self, query: Query, workers: Optional[int] = None, batch_size: int = 64,
+                 queue_size: Optional[int] = None, max_results: Optional[int] = None,
+                 max_depth: Optional[int] = None, index: Optional[str] = None):
+        self.query = query
+        self.index = index
+        self.workers = workers if workers is not None else os.cpu_count()
+        self.batch_size = batch_size
+        self.queue_size = queue_size if queue_size is not None else 2 * max(1, self.workers)
+        self.max_results = max_results
+        self.max_depth = max_depth
+
+    def scan(self, basepaths: Iterable[str]) -> Iterator[str]:
+        '''Yield the matching paths as soon as they are found (so not
+        necessarily in the order they are walked).'''
+        results = self._scan_serial(basepaths) if not self.workers else self._scan_pool(basepaths)
+
+        for count, path in enumerate(results, start=1):
+            yield path
+
+            if self.max_results is not None and count >= self.max_results:
+                results.close()
+                break
+
+    def _handle(self, matches, entries):
+        if entries:
+            get_index(self.index).put_many(entries)
+
+        return matches
+
+    def _scan_serial(self, basepaths):
+        batches = _batches(iter_paths(basepaths, max_depth=self.max_depth), self.batch_size)
+
+        for batch in batches:
+            yield from self._handle(*scan_batch(self.query, batch, self.index))
+
+    def _scan_pool(self, basepaths):
+        batches = _batches(iter_paths(basepaths, max_depth=self.max_depth), self.batch_size)
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        pending = set()
+
+        try:
+            for batch in batches:
+                pending.add(executor.submit(scan_batch, self.query, batch, self.index))
+
+                if len(pending) < self.queue_size:
+                    continue
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield from self._handle(*future.result())
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield from self._handle(*future.result())
+        finally:
+            # here also when the consumer stops early
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
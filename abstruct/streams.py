@@ -1,26 +1,397 @@
 import io
 import logging
+import os
+import re
+import struct
+import threading
+from collections import OrderedDict
+from mmap import mmap as MemoryMap, ACCESS_READ, PAGESIZE
 
 from .properties import Offset
 
 
+class MemoryViewIO(object):
+    '''Read-only file-like object over a buffer (an mmap, bytes, ...) that
+    can hand out memoryview slices of it without copying the data.'''
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def read_view(self, size=-1):
+        start = self.position
+        end = len(self.buffer) if size is None or size < 0 else min(start + size, len(self.buffer))
+        end = max(start, end)
+
+        self.position = end
+
+        return self.buffer[start:end]
+
+    def read(self, size=-1):
+        return bytes(self.read_view(size))
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+    def read_until(self, delimiter, limit=-1):
+        end = len(self.buffer) if limit is None or limit < 0 else min(self.position + limit, len(self.buffer))
+        match = _search(self.buffer, delimiter, self.position, end)
+
+        return self.read(match - self.position if match is not None else end - self.position)
+
+
+class BufferIO(object):
+    '''Writable file-like object over a buffer allocated beforehand (usually
+    a bytearray of the size given by relayout()), the values are packed
+    directly into it with pack_into(). Writing past the end grows the buffer
+    if it's a bytearray.'''
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def _reserve(self, size):
+        end = self.position + size
+        missing = end - len(self.buffer)
+
+        if missing > 0:
+            if not isinstance(self.buffer, bytearray):
+                raise ValueError(f'the buffer is too small, {end} bytes are needed')
+
+            self.buffer.extend(bytes(missing))
+
+        return end
+
+    def write(self, data):
+        end = self._reserve(len(data))
+        self.buffer[self.position:end] = data
+        self.position = end
+
+        return len(data)
+
+    def pack_into(self, layout, *values):
+        '''Like struct.pack_into() at the actual position, layout is a struct.Struct
+        or a format.'''
+        if isinstance(layout, struct.Struct):
+            end = self._reserve(layout.size)
+            layout.pack_into(self.buffer, self.position, *values)
+        else:
+            end = self._reserve(struct.calcsize(layout))
+            struct.pack_into(layout, self.buffer, self.position, *values)
+
+        self.position = end
+
+    def read(self, size=-1):
+        end = len(self.buffer) if size is None or size < 0 else min(self.position + size, len(self.buffer))
+        data = bytes(self.buffer[self.position:end])
+        self.position = max(self.position, end)
+
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.buffer)
+
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+    def close(self):
+        pass
+
+
+class BlockCacheIO(object):
+    '''Read-only file-like object that reads the underlying one (that must be
+    seekable) in aligned blocks of block_size bytes, keeping at most max_size
+    bytes of them with a LRU policy: the small reads done by the fields are
+    served from memory and the blocks missing for a read are fetched with a
+    single read when contiguous.
+
+    It's useful where the data cannot be memory mapped and each read is costly,
+    like unbuffered files or files on a network filesystem.'''
+
+    BLOCK_SIZE = 16 * 1024
+
+    def __init__(self, raw, block_size=None, max_size=1 << 20):
+        self.raw = raw
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.max_blocks = max(1, max_size // self.block_size)
+        self.blocks = OrderedDict()  # index -> data, from the least recently used
+        self.end = None  # index of the first block past the end of the data, when known
+        self.position = 0
+        self.hits = 0
+        self.misses = 0
+        self.raw_reads = 0
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}({self.raw!r}, block_size={self.block_size}, blocks={len(self.blocks)})>'
+
+    def _read_raw(self, offset, size):
+        '''Read size bytes from offset (all the remaining ones if size is negative):
+        a raw file can return less than asked, so it's read again until the
+        data is complete or the end is reached (an empty read).'''
+        self.raw.seek(offset)
+
+        if size is None or size < 0:
+            self.raw_reads += 1
+            return self.raw.read()
+
+        chunks = []
+        while size > 0:
+            chunk = self.raw.read(size)
+            self.raw_reads += 1
+
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    def _fetch(self, first, count):
+        '''Read count blocks starting from the one with index first.'''
+        data = self._read_raw(first * self.block_size, count * self.block_size)
+
+        # a block shorter than the others can be only the last one
+        for idx in range(count):
+            block = data[idx * self.block_size:(idx + 1) * self.block_size]
+
+            if len(block) < self.block_size:
+                self.end = first + idx + (1 if block else 0)
+
+            if block:
+                self.blocks[first + idx] = block
+
+            if len(block) < self.block_size:
+                break
+
+    def _get_blocks(self, first, last):
+        '''Return the blocks from first to last (included) as a list.'''
+        if self.end is not None:
+            last = min(last, self.end - 1)
+
+        # coalesce the contiguous runs of missing blocks
+        missing, missing_start = 0, None
+        for idx in range(first, last + 2):
+            if idx <= last and idx not in self.blocks:
+                missing += 1
+                if missing_start is None:
+                    missing_start = idx
+                continue
+
+            if missing_start is not None:
+                self._fetch(missing_start, idx - missing_start)
+                missing_start = None
+
+        blocks = []
+        for idx in range(first, last + 1):
+            block = self.blocks.get(idx)
+            if block is None:  # past the end
+                break
+
+            self.blocks.move_to_end(idx)
+            blocks.append(block)
+
+        self.misses += missing
+        self.hits += max(0, len(blocks) - missing)
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+
+        return blocks
+
+    def read(self, size=-1):
+        start = self.position
+
+        # what doesn't fit in the cache is read directly
+        if size is None or size < 0 or size > self.max_blocks * self.block_size:
+            data = self._read_raw(start, size)
+            self.position += len(data)
+
+            return data
+
+        if size == 0:
+            return b''
+
+        first = start // self.block_size
+        blocks = self._get_blocks(first, (start + size - 1) // self.block_size)
+
+        offset = start - first * self.block_size
+        data = blocks[0][offset:offset + size] if len(blocks) == 1 else b''.join(blocks)[offset:offset + size]
+        self.position += len(data)
+
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.raw.seek(0, io.SEEK_END)
+
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+
+        self.position = offset
+
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.blocks.clear()
+        self.raw.close()
+
+
+def _search(buffer, delimiter, start, end):
+    '''Return the offset just after the first occurrence of delimiter in
+    buffer[start:end], None if not found. The regex engine works on any
+    object supporting the buffer protocol so we avoid copying the data.'''
+    match = re.compile(re.escape(delimiter)).search(buffer, start, end)
+
+    return match.end() if match else None
+
+
+class StreamStats(object):
+    '''Counters of the operations done on a Stream: pass an instance to the
+    Stream to enable them. With trace set to True each operation is also
+    recorded as a tuple (operation, offset, size) to be examined with dump().
+
+    The pages are counted to see how much of the file a format touches and
+    how scattered the accesses are, the backward seeks are the ones that hurt
+    the most on slow storage (a network filesystem for example) since they
+    defeat the readahead.'''
+
+    PAGE_SIZE = PAGESIZE
+
+    def __init__(self, trace=False):
+        self.reads = 0
+        self.bytes_read = 0
+        self.seeks = 0
+        self.backward_seeks = 0
+        self.pages = set()
+        self.position = 0  # where the last operation left the stream
+        self.trace = [] if trace else None
+
+    def __repr__(self):
+        return (
+            f'<{self.__class__.__name__}(reads={self.reads}, bytes_read={self.bytes_read}, '
+            f'seeks={self.seeks}, backward_seeks={self.backward_seeks}, pages={len(self.pages)})>'
+        )
+
+    def read(self, offset, size):
+        self.reads += 1
+        self.bytes_read += size
+        self.position = offset + size
+
+        if size:
+            self.pages.update(range(offset // self.PAGE_SIZE, (offset + size - 1) // self.PAGE_SIZE + 1))
+
+        if self.trace is not None:
+            self.trace.append(('read', offset, size))
+
+    def seek(self, offset):
+        self.seeks += 1
+
+        if offset < self.position:
+            self.backward_seeks += 1
+
+        if self.trace is not None:
+            self.trace.append(('seek', offset, offset - self.position))
+
+        self.position = offset
+
+    def summary(self) -> str:
+        return (
+            f'{self.reads} reads for {self.bytes_read} bytes, {self.seeks} seeks '
+            f'({self.backward_seeks} backward), {len(self.pages)} pages of {self.PAGE_SIZE} bytes touched'
+        )
+
+    def dump(self) -> str:
+        '''Return the summary followed by the trace (if enabled), one operation
+        per line with the offset and the size read or the distance of the seek.'''
+        lines = [self.summary()]
+
+        for operation, offset, size in self.trace or []:
+            lines.append(f'{operation:4s} {offset:#010x} {size:+d}')
+
+        return '\n'.join(lines)
+
+
 class Stream(object):
     '''This is a simple wrapper around String/File object to
     uniform its properties: mainly we need to have a seek() method
-    that handles correctly Offset() instances.'''
+    that handles correctly Offset() instances.
+
+    If mmap is True a file is memory mapped and read_view() returns memoryview
+    slices of the mapping instead of copying the data; the same happens
+    when the object is already an mmap or a memoryview.'''
+
+    BLOCK_SIZE = 64 * 1024  # used when reading blocks of data from a file
 
-    def __init__(self, obj, flags='r'):
-        '''Here we normalize the object in order to be accessed as a normal file object'''
+    def __init__(self, obj, flags='r', mmap=False, stats=None, cache_size=0):
+        '''Here we normalize the object in order to be accessed as a normal file object,
+        stats is a StreamStats that counts the operations done.
+
+        With cache_size a file (not memory mapped) is read through a BlockCacheIO
+        keeping at most that many bytes, to configure the size of the blocks pass
+        directly a BlockCacheIO as obj.
+
+        With flags "w" a path is opened (and truncated) for writing, pack() writes
+        each field directly in it, with "r+" it's opened for reading and writing;
+        any other writable file object can be passed as is.'''
         self._type = type(obj)
         self.flags = flags  # this probably need to be a more elaborate value (like mmap)
+        self.mmap = mmap
+        self.cache_size = cache_size
         self.obj = obj
         self._need_close = False
         self.history = []
         self.logger = logging.getLogger(__name__)
+        self.stats = stats
 
         init_method_name = 'init_%s' % self.obj.__class__.__name__
 
-        init_method = getattr(self, init_method_name)
+        init_method = getattr(self, init_method_name, None)
+
+        if init_method is None:
+            if not hasattr(self.obj, 'seek'):
+                raise AttributeError(f'a Stream cannot be created from {self.obj.__class__.__name__}')
+
+            init_method = self.init_file
 
         init_method()
 
@@ -33,43 +404,195 @@ class Stream(object):
 
     def init_str(self):
         '''We think this is a path'''
-        self.logger.debug('opening path \'%s\'' % self.obj)
-        self.obj = open(self.obj, 'rb')
+        self.logger.debug('opening path \'%s\'', self.obj)
         self._need_close = True
 
+        if 'w' in self.flags:
+            self.obj = open(self.obj, 'w+b')
+        elif '+' in self.flags:  # to modify it in place (see Chunk.repack())
+            self.obj = open(self.obj, 'r+b')
+        elif self.mmap:
+            self.obj = open(self.obj, 'rb')
+            self._map_file()
+        elif self.cache_size:
+            # the cache does the buffering
+            self.obj = BlockCacheIO(open(self.obj, 'rb', buffering=0), max_size=self.cache_size)
+        else:
+            self.obj = open(self.obj, 'rb')
+
+    def _map_file(self):
+        f = self.obj
+
+        try:
+            mapping = MemoryMap(f.fileno(), 0, access=ACCESS_READ)
+        except ValueError:  # empty files cannot be mapped
+            mapping = b''
+        finally:
+            f.close()
+
+        # the mapping is released when the last memoryview referencing it is gone
+        self._need_close = False
+        self.obj = MemoryViewIO(mapping)
+
     def init_bytes(self):
         '''We think these are raw bytes'''
-        self.obj = io.BytesIO(self.obj)
+        self.obj = io.BytesIO(self.obj) if not self.mmap else MemoryViewIO(self.obj)
 
-    def seek(self, offset):
-        real_offset = None
+    def init_mmap(self):
+        self.obj = MemoryViewIO(self.obj)
+
+    def init_BlockCacheIO(self):
+        pass
+
+    def init_BufferIO(self):
+        pass
 
+    def init_file(self):
+        '''Any object with the interface of a file, it's used as is.'''
+        pass
+
+    def init_memoryview(self):
+        self.obj = MemoryViewIO(self.obj)
+
+    def read(self, size=-1):
+        '''Read at most size bytes, all the remaining ones if size is negative.'''
+        if self.stats is None:
+            return self.obj.read(size)
+
+        offset = self.obj.tell()
+        data = self.obj.read(size)
+        self.stats.read(offset, len(data))
+
+        return data
+
+    def read_view(self, size=-1):
+        '''Like read() but if the stream is backed by a buffer it returns
+        a memoryview referencing it without copying the data.'''
+        read_view = getattr(self.obj, 'read_view', None)
+
+        if not read_view:
+            return self.read(size)
+
+        if self.stats is None:
+            return read_view(size)
+
+        offset = self.obj.tell()
+        data = read_view(size)
+        self.stats.read(offset, len(data))
+
+        return data
+
+    def _real_offset(self, offset):
         if isinstance(offset, Offset):
-            real_offset = offset.resolve()
+            return offset.resolve()
         elif isinstance(offset, int):
-            real_offset = offset
-        else:
-            raise ValueError('\'%s\' is the wrong kind of offset to use' % offset.__class__.__name__)
+            return offset
+
+        raise ValueError('\'%s\' is the wrong kind of offset to use' % offset.__class__.__name__)
 
-        self.logger.debug('stream seek() at %08x' % real_offset)
+    def seek(self, offset):
+        real_offset = self._real_offset(offset)
+
+        self.logger.debug('stream seek() at %08x', real_offset)
         self.obj.seek(real_offset)
 
+        if self.stats is not None:
+            self.stats.seek(real_offset)
+
     def read_all(self):
-        '''Here we try to implement a method that returns all the data possible
-        FIXME: find a better way to do this.
-        '''
-        data = []
-        is_there_more = True
-        while is_there_more:
-            b = self.read(1)
-            is_there_more = (len(b) != 0)
-            data.append(b)
-
-        return b''.join(data)
+        '''Return all the data from the actual position to the end of the stream.'''
+        return self.read()
+
+    def at_end(self) -> bool:
+        '''Return True if there is nothing left to read from the actual position.'''
+        offset = self.tell()
+
+        if not self.read(1):
+            return True
+
+        self.seek(offset)
+
+        return False
+
+    def read_until(self, delimiter, limit=-1):
+        '''Read up to and including delimiter, stopping before if limit bytes
+        are read or the end of the stream is reached.'''
+        read_until = getattr(self.obj, 'read_until', None)
+
+        if read_until:
+            offset = self.obj.tell()
+            data = read_until(delimiter, limit)
+
+            if self.stats is not None:
+                self.stats.read(offset, len(data))
+
+            return data
+
+        if isinstance(self.obj, io.BytesIO):
+            start = self.obj.tell()
+            with self.obj.getbuffer() as buffer:
+                end = len(buffer) if limit is None or limit < 0 else min(start + limit, len(buffer))
+                match = _search(buffer, delimiter, start, end)
+
+            return self.read((match if match is not None else end) - start)
+
+        return self._read_until_blocks(delimiter, limit)
+
+    def _read_until_blocks(self, delimiter, limit):
+        '''Generic version for file-like objects: read blocks of data and
+        seek back just after the delimiter when it's found.'''
+        start = self.tell()
+        data = bytearray()
+
+        while limit is None or limit < 0 or len(data) < limit:
+            size = self.BLOCK_SIZE if limit is None or limit < 0 else min(self.BLOCK_SIZE, limit - len(data))
+            block = self.read(size)
+
+            if not block:
+                break
+
+            # the delimiter could be across two blocks
+            search_from = max(0, len(data) - len(delimiter) + 1)
+            data += block
+
+            match = _search(data, delimiter, search_from, len(data))
+
+            if match is not None:
+                del data[match:]
+                self.seek(start + match)
+                break
+
+        return bytes(data)
 
     def write(self, data):
         return self.obj.write(data)
 
+    def write_packed(self, layout, *values):
+        '''Write the values packed with layout (a struct.Struct or a format): with a
+        BufferIO they are packed in place and None is returned, otherwise the
+        data written is returned.'''
+        pack_into = getattr(self.obj, 'pack_into', None)
+
+        if pack_into is not None:
+            pack_into(layout, *values)
+            return None
+
+        data = layout.pack(*values) if isinstance(layout, struct.Struct) else struct.pack(layout, *values)
+        self.obj.write(data)
+
+        return data
+
+    def getvalue(self):
+        '''Return the data written if the stream is in memory, None when it's a file
+        since its content can be bigger than the memory available.'''
+        getvalue = getattr(self.obj, 'getvalue', None)
+
+        return getvalue() if getvalue else None
+
+    def close(self):
+        self._need_close = False
+        self.obj.close()
+
     # TODO: create contextmanager
     def save(self):
         self.history.append(self.obj.tell())
@@ -77,3 +600,120 @@ class Stream(object):
     def restore(self):
         old_seek = self.history.pop()
         self.obj.seek(old_seek)
+
+
+class PositionalStream(Stream):
+    '''A read-only Stream without a shared cursor: the data is read with
+    positional reads (os.pread() for files, slices for bytes and mmap) and
+    the position used by seek()/tell()/read() is local to each thread.
+
+    This means that more threads can unpack from the same instance at the same
+    time, each one starting from offset zero.'''
+
+    def __init__(self, obj, flags='r', mmap=False, stats=None):
+        self._local = threading.local()
+        super().__init__(obj, flags=flags, mmap=mmap, stats=stats)
+
+    def init_bytes(self):
+        self.obj = MemoryViewIO(self.obj)
+
+    @property
+    def position(self):
+        return getattr(self._local, 'position', 0)
+
+    @position.setter
+    def position(self, value):
+        self._local.position = value
+
+    def size(self):
+        if isinstance(self.obj, MemoryViewIO):
+            return len(self.obj)
+
+        return os.fstat(self.obj.fileno()).st_size
+
+    def _clamp(self, offset, size):
+        end = self.size()
+
+        return offset, end if size is None or size < 0 else max(offset, min(offset + size, end))
+
+    def pread(self, offset, size=-1):
+        '''Read at most size bytes starting from offset, the position is not used nor changed.'''
+        if not isinstance(self.obj, MemoryViewIO):
+            if size is None or size < 0:
+                size = max(0, self.size() - offset)
+
+            return os.pread(self.obj.fileno(), size, offset)
+
+        start, end = self._clamp(offset, size)
+
+        return bytes(self.obj.buffer[start:end])
+
+    def pread_view(self, offset, size=-1):
+        if not isinstance(self.obj, MemoryViewIO):
+            return self.pread(offset, size)
+
+        start, end = self._clamp(offset, size)
+
+        return self.obj.buffer[start:end]
+
+    def seek(self, offset):
+        self.position = self._real_offset(offset)
+
+        if self.stats is not None:
+            self.stats.seek(self.position)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        data = self.pread(self.position, size)
+
+        if self.stats is not None:
+            self.stats.read(self.position, len(data))
+
+        self.position += len(data)
+
+        return data
+
+    def read_view(self, size=-1):
+        data = self.pread_view(self.position, size)
+
+        if self.stats is not None:
+            self.stats.read(self.position, len(data))
+
+        self.position += len(data)
+
+        return data
+
+    def read_all(self):
+        return self.read()
+
+    def read_until(self, delimiter, limit=-1):
+        if isinstance(self.obj, MemoryViewIO):
+            start, end = self._clamp(self.position, limit)
+            match = _search(self.obj.buffer, delimiter, start, end)
+
+            return self.read((match if match is not None else end) - start)
+
+        return self._read_until_blocks(delimiter, limit)
+
+    def write(self, data):
+        raise io.UnsupportedOperation('%s is read-only' % self.__class__.__name__)
+
+    @property
+    def history(self):
+        try:
+            return self._local.history
+        except AttributeError:
+            self._local.history = []
+            return self._local.history
+
+    @history.setter
+    def history(self, value):
+        self._local.history = value
+
+    def save(self):
+        self.history.append(self.position)
+
+    def restore(self):
+        self.position = self.history.pop()
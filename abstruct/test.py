@@ -1,7 +1,14 @@
+import io
 import logging
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import unittest
+import zipfile
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 from enum import Flag, Enum, auto
 from .enum import Compliant
 
@@ -20,6 +27,7 @@ from .executables.elf.enum import (
 from .fields import Endianess
 
 from .images.png import (
+    PNGChunk,
     PNGColorType,
     PNGHeader,
     PNGFile,
@@ -40,8 +48,15 @@ from .compression.zip import (
 
 from .core import Chunk, Meta, Dependency
 from .exceptions import AbstructException, MagicException
-from .streams import Stream
-from . import fields
+from .streams import Stream, PositionalStream, StreamStats, BlockCacheIO, BufferIO
+from .benchmarks import Case, run as run_benchmarks
+from .benchmarks.inputs import stk500_inputs
+from .benchmarks.generators import generate_elf, generate_png, generate_zip
+from .scanner import Query, Scanner, condition_paths
+from .index import Record, ReplayProxy, ScanIndex, MissingPath
+from .plan import MagicPrefix, has_fixed_size
+from . import profiling
+from . import fields, profile
 
 
 logging.basicConfig(level=logging.DEBUG if 'DEBUG' in os.environ else logging.INFO)
@@ -73,6 +88,141 @@ class StreamTests(unittest.TestCase):
         self.assertEqual(stream.read_all(), b'\x03\x04\x05')
         self.assertEqual(stream.tell(), 5)
 
+    def test_mmap_stream_read_view(self):
+        data = b'\x01\x02\x03\x04\x05'
+        path_data = '/tmp/auaua'
+        with open(path_data, 'wb') as f:
+            f.write(data)
+
+        stream = Stream(path_data, mmap=True)
+
+        self.assertEqual(stream.read(1), b'\x01')
+
+        view = stream.read_view(3)
+
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, b'\x02\x03\x04')
+        self.assertEqual(stream.read_view(10), b'\x05')
+        self.assertEqual(stream.tell(), 5)
+
+    def test_stats(self):
+        stats = StreamStats(trace=True)
+        stats.PAGE_SIZE = 4096
+        stream = Stream(b'\x00' * 10000, stats=stats)
+
+        stream.seek(8192)
+        stream.read(10)
+        stream.seek(100)  # backward
+        stream.read(4000)  # across two pages
+        stream.read_view(2)
+
+        self.assertEqual(stats.reads, 3)
+        self.assertEqual(stats.bytes_read, 4012)
+        self.assertEqual(stats.seeks, 2)
+        self.assertEqual(stats.backward_seeks, 1)
+        self.assertEqual(stats.pages, set([0, 1, 2]))
+        self.assertEqual(stats.trace[:3], [('seek', 8192, 8192), ('read', 8192, 10), ('seek', 100, -8102)])
+        self.assertIn('1 backward', stats.dump())
+
+    def test_block_cache_short_reads(self):
+        '''a raw file can return less than asked without being at the end'''
+        class ShortReads(io.BytesIO):
+
+            def read(self, size=-1):
+                return super().read(min(size, 4096) if size is not None and size >= 0 else size)
+
+        data = bytes(range(256)) * 100
+        cache = BlockCacheIO(ShortReads(data), block_size=8000, max_size=16000)
+        stream = Stream(cache)
+
+        self.assertEqual(stream.read(8000), data[:8000])
+        self.assertIsNone(cache.end)
+
+        stream.seek(20000)
+        self.assertEqual(stream.read(100), data[20000:20100])
+        stream.seek(0)
+        self.assertEqual(stream.read(20000), data[:20000])  # bigger than the cache
+
+        stream.seek(25000)
+        self.assertEqual(stream.read(1000), data[25000:])
+        self.assertEqual(cache.end, 4)
+
+    def test_buffer_io(self):
+        buffer = bytearray(4)
+        stream = Stream(BufferIO(buffer))
+
+        stream.seek(2)
+        self.assertIsNone(stream.write_packed('<H', 0x0102))
+        stream.write(b'\x03\x04')  # past the end the buffer grows
+
+        self.assertEqual(buffer, b'\x00\x00\x02\x01\x03\x04')
+        self.assertEqual(Stream(b'').write_packed('<H', 0x0102), b'\x02\x01')
+
+    def test_block_cache(self):
+        data = bytes(range(256)) * 4
+        cache = BlockCacheIO(io.BytesIO(data), block_size=100, max_size=300)
+        stream = Stream(cache)
+
+        stream.seek(150)
+        self.assertEqual(stream.read(300), data[150:450])  # misses coalesced in a single read
+        self.assertEqual((cache.misses, cache.raw_reads), (4, 1))
+
+        stream.seek(310)
+        self.assertEqual(stream.read(4), data[310:314])
+        self.assertEqual((cache.hits, cache.raw_reads), (1, 1))
+        self.assertEqual(list(cache.blocks), [2, 4, 3])  # at most three blocks, the first evicted
+
+        stream.seek(1000)
+        self.assertEqual(stream.read(100), data[1000:])
+        stream.seek(0)
+        self.assertEqual(stream.read_all(), data)
+
+    def test_read_until(self):
+        data = b'miao\x00\x00bau\x00\x00'
+        path_data = '/tmp/auaua'
+        with open(path_data, 'wb') as f:
+            f.write(data)
+
+        streams = [Stream(data), Stream(path_data), Stream(path_data, mmap=True)]
+        # force the delimiter to be across two blocks
+        streams[1].BLOCK_SIZE = 5
+
+        for stream in streams:
+            self.assertEqual(stream.read_until(b'\x00\x00'), b'miao\x00\x00')
+            self.assertEqual(stream.tell(), 6)
+            self.assertEqual(stream.read_until(b'\x00\x00', limit=2), b'ba')
+            self.assertEqual(stream.read_until(b'\x00\x00'), b'u\x00\x00')
+            self.assertEqual(stream.read_until(b'\x00\x00'), b'')
+            self.assertEqual(stream.tell(), 11)
+
+            stream.seek(4)
+            self.assertEqual(stream.read_until(b'\xff'), b'\x00\x00bau\x00\x00')
+            stream.seek(6)
+            self.assertEqual(stream.read_all(), b'bau\x00\x00')
+
+    def test_positional_stream(self):
+        data = b'\x01\x02\x03\x04\x05'
+        path_data = '/tmp/auaua'
+        with open(path_data, 'wb') as f:
+            f.write(data)
+
+        for stream in [PositionalStream(data), PositionalStream(path_data), PositionalStream(path_data, mmap=True)]:
+            self.assertEqual(stream.pread(3, 10), b'\x04\x05')
+            self.assertEqual(stream.tell(), 0)
+
+            stream.seek(1)
+            self.assertEqual(stream.read(2), b'\x02\x03')
+            self.assertEqual(stream.read_all(), b'\x04\x05')
+
+            # each thread has its own position
+            positions = []
+            thread = threading.Thread(target=lambda: positions.append((stream.tell(), stream.read(1))))
+            thread.start()
+            thread.join()
+
+            self.assertEqual(positions, [(0, b'\x01')])
+            self.assertEqual(stream.tell(), 5)
+
 
 class CoreTests(unittest.TestCase):
 
@@ -117,6 +267,25 @@ class CoreTests(unittest.TestCase):
         self.assertEqual(son.field_b.value, 0x04030201, f'field_b is {son.field_b.value:x}')
         self.assertEqual(son.field_c.value, field_c_value)
 
+    def test_create_from_prototype(self):
+        '''fields are instantiated from the prototype's constructor arguments'''
+        class Dummy(Chunk):
+            field = fields.StructField('I', default=0xcafe)
+            items = fields.ArrayField(fields.StructField('B'), default=[])
+
+        prototype = Dummy.__dict__['field'].field
+
+        a, b = Dummy(), Dummy()
+
+        self.assertIsNot(a.field, prototype)
+        self.assertIs(a.field.father, a)
+        self.assertEqual(a.field.name, 'field')
+        self.assertEqual(a.field.value, 0xcafe)
+        # mutable arguments are not shared between instances
+        a.items.append(fields.StructField('B'))
+        self.assertEqual(len(a.items), 1)
+        self.assertEqual(len(b.items), 0)
+
     def test_field_from_chunk(self):
         class Dummy(Chunk):
             field = fields.StructField('i')
@@ -277,6 +446,165 @@ class CoreTests(unittest.TestCase):
             b'\x04\x00\x00\x00\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41\x41'
         )
 
+    def test_size_cache(self):
+        class DummyEntry(Chunk):
+            field = fields.StructField('I')
+
+        class DummyChunk(Chunk):
+            length = fields.StructField('B')
+            data = fields.StringField(Dependency('.length'))
+            entries = fields.ArrayField(DummyEntry(), n=2)
+            tail = fields.StringField(2)
+
+        dummy = DummyChunk(b'\x02AB' + b'\x00' * 10)
+
+        self.assertEqual(dummy.size(), 13)
+        self.assertEqual(dummy.get_cached_size(), 13)
+        self.assertEqual(dummy.entries.get_cached_size(), 8)
+
+        # a change in a descendant invalidates only its ancestors
+        dummy.tail.value = b'XYZ'
+        self.assertIsNone(dummy.get_cached_size())
+        self.assertEqual(dummy.entries.get_cached_size(), 8)
+        self.assertEqual(dummy.size(), 14)
+
+        dummy.entries.append(dummy.entries.instance_element())
+        self.assertIsNone(dummy.get_cached_size())
+        self.assertEqual(dummy.size(), 18)
+
+        # writing a field used by a dependency invalidates all the sizes
+        dummy.data.value = b'ABCD'  # it writes length
+        self.assertIsNone(dummy.entries.get_cached_size())
+        self.assertEqual(dummy.size(), 20)
+
+
+class PlanTests(unittest.TestCase):
+
+    def test_runs(self):
+        '''adjacent StructFields are unpacked with a single read'''
+        class Dummy(Chunk):
+            a = fields.StructField('I')
+            b = fields.StructField('H')
+            c = fields.StructField('B')
+            d = fields.StringField(2)
+            e = fields.StructField('I', endianess=Endianess.BIG_ENDIAN)
+            f = fields.StructField('H', endianess=Endianess.BIG_ENDIAN)
+
+        reads = []
+
+        class CountingStream(Stream):
+
+            def read(self, size):
+                reads.append(size)
+                return self.obj.read(size)
+
+        contents = b'\x01\x02\x03\x04\x05\x06\x07AB\x0a\x0b\x0c\x0d\x0e\x0f'
+
+        dummy = Dummy()
+        dummy.unpack(CountingStream(contents))
+
+        self.assertEqual(reads, [7, 2, 6])
+        self.assertEqual(dummy.a.value, 0x04030201)
+        self.assertEqual(dummy.b.value, 0x0605)
+        self.assertEqual(dummy.c.value, 0x07)
+        self.assertEqual(dummy.c.raw, b'\x07')
+        self.assertEqual(dummy.e.value, 0x0a0b0c0d)
+        self.assertEqual(dummy.f.value, 0x0e0f)
+        self.assertEqual([_.offset for __, _ in dummy.get_fields()], [0, 4, 6, 7, 9, 13])
+
+        self.assertEqual(dummy.pack(), contents)
+
+    def test_magic_prefix(self):
+        self.assertEqual(MagicPrefix.for_class(ElfFile).patterns, [(0, b'\x7fELF')])
+        self.assertEqual(MagicPrefix.for_class(PNGFile).patterns, [(0, b'\x89PNG\r\n\x1a\n')])
+
+        class Dummy(Chunk):
+            a = fields.StructField('H')
+            b = fields.StructField('B', default=0xaa, is_magic=True)
+            c = fields.StringField(Dependency('a'))
+            d = fields.StringField(2, default=b'\xca\xfe', is_magic=True)
+
+        prefix = MagicPrefix.for_class(Dummy)
+
+        # d is after a field with a size known only at runtime
+        self.assertEqual(prefix.patterns, [(2, b'\xaa')])
+        self.assertTrue(prefix.match(b'\x00\x00\xaa'))
+        self.assertFalse(prefix.match(b'\x00\x00\xab'))
+        self.assertFalse(prefix.match(b'\x00'))
+
+    def test_runs_dependent_format(self):
+        '''a format depending on a field of the same run ends it'''
+        class DummyAddress(fields.StructField):
+
+            def get_format(self):
+                return '<Q' if self.father.wide.value else '<I'
+
+        class Dummy(Chunk):
+            wide = fields.StructField('B')
+            address = DummyAddress('I')
+            tail = fields.StructField('B')
+
+        class DummyEndianess(Chunk):
+            big = fields.StructField('B')
+            number = fields.StructField('H', endianess=Dependency('.big'))
+
+        dummy = Dummy(b'\x01\x01\x00\x00\x00\x02\x00\x00\x00\x07')
+
+        self.assertEqual(dummy.address.value, 0x200000001)
+        self.assertEqual(dummy.tail.value, 0x07)
+        # the run starts after the field the format depends on
+        self.assertEqual([_.names for _ in dummy.get_plan(dummy.get_fields()).unpack_runs.values()], [('address', 'tail')])
+
+        dummy = DummyEndianess(bytes([Endianess.BIG_ENDIAN.value]) + b'\x01\x02')
+        self.assertEqual(dummy.number.value, 0x0102)
+        self.assertEqual(dummy.get_plan(dummy.get_fields()).unpack_runs, {})
+
+    def test_runs_external_dependencies(self):
+        '''a dependency from the root or from an ancestor can come back into the run'''
+        class DummyInner(Chunk):
+            big = fields.StructField('B', enum=Endianess, default=Endianess.LITTLE_ENDIAN)
+            number = fields.StructField('H', endianess=Dependency('inner.big'))
+            other = fields.StructField('H', endianess=Dependency('@DummyOuter.inner.big'))
+
+        class DummyOuter(Chunk):
+            inner = DummyInner()
+
+        data = bytes([Endianess.BIG_ENDIAN.value]) + b'\x01\x02\x03\x04'
+        dummy = DummyOuter(data)
+
+        self.assertEqual(dummy.inner.number.value, 0x0102)
+        self.assertEqual(dummy.inner.other.value, 0x0304)
+
+        # the run is there but it's not used for these data
+        inner = dummy.inner
+        run = inner.get_plan(inner.get_fields()).unpack_runs[0]
+        self.assertEqual(run.checked, (1, 2))
+        self.assertIsNone(run.unpack(inner.get_fields(), Stream(data[1:])))
+
+    def test_fixed_size_dependent_format(self):
+        class DummyAddress(fields.StructField):
+
+            def get_format(self):
+                return '<Q' if self.father.wide.value else '<I'
+
+        class DummyEntry(Chunk):
+            wide = fields.StructField('B')
+            address = DummyAddress('I')
+
+        self.assertFalse(has_fixed_size(DummyEntry()))
+        self.assertTrue(has_fixed_size(elf_fields.SymbolTableEntry()))
+
+    def test_runs_not_enough_data(self):
+        '''with truncated data the error points to the right field'''
+        class Dummy(Chunk):
+            a = fields.StructField('I')
+            b = fields.StructField('I')
+
+        with self.assertRaises(AbstructException) as context:
+            Dummy(b'\x01\x02\x03\x04\x05')
+
+        self.assertEqual(context.exception.chain, ['b'])
+
 
 class PaddingFieldTests(unittest.TestCase):
 
@@ -403,6 +731,16 @@ class FieldsTests(unittest.TestCase):
         self.assertEqual(d.count.value, 3)
         self.assertEqual(len(d.items), 5)
 
+    def test_array_lazy_to_list(self):
+        array = fields.ArrayField(fields.StringField(0), n=3, lazy=True)
+        array.unpack(Stream(b''))
+        self.assertIsInstance(array.value, fields.LazyElements)
+
+        # the elements already unpacked are reused even if falsy
+        element = array.value[1]
+        self.assertEqual(len(element), 0)
+        self.assertIs(array.value.to_list()[1], element)
+
     def test_select(self):
         class DummyType(Flag):
             FIRST = 0
@@ -447,6 +785,29 @@ class FieldsTests(unittest.TestCase):
         dummy.garbage.value = b'ABCD'
         self.assertEqual(dummy.length.value, 4, f'check we have an updated \'length\' field')
 
+    def test_dependency_cache(self):
+        '''the resolution is cached but it follows the writes'''
+        class DummyChunk(Chunk):
+            length = fields.StructField('I')
+            garbage = fields.StringField(Dependency('.length'))
+
+        dummy = DummyChunk()
+        garbage = dummy.garbage
+        dependency = garbage.get_dependencies()['_n']
+
+        self.assertIs(dependency.path, Dependency('.length').path)
+        self.assertEqual(garbage._n, 0)
+        self.assertIs(garbage.__dict__['_dependency_cache'][dependency][1], dummy.length)
+
+        dummy.length.value = 3
+        self.assertEqual(garbage._n, 3)
+
+        # replacing the field the dependency is resolved again
+        length = fields.StructField('I')
+        length.value = 5
+        dummy.length = length
+        self.assertEqual(garbage._n, 5)
+
     def test_crc32(self):
         class DummyChunk(Chunk):
             dataA = fields.StructField('I')
@@ -610,6 +971,260 @@ class ELFTest(unittest.TestCase):
         print(elf.dynamic.get(ElfDynamicTagType.DT_REL))
         print(elf.dynamic.get(ElfDynamicTagType.DT_PLTREL))
 
+    def test_lazy(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        elf = ElfFile(path_elf, lazy=True)
+
+        self.assertEqual(elf.header.e_machine.value, ElfMachine.EM_386)
+        # only the header has been unpacked
+        self.assertEqual(elf.__dict__['sections'].value, None)
+        self.assertEqual(elf.__dict__['sections_header'].value, [])
+
+        eager = ElfFile(path_elf)
+
+        self.assertEqual(elf.section_names, eager.section_names)
+        self.assertEqual(elf.sections_header.value[29].offset, 7212)
+        self.assertEqual(len(elf.segments.value), 9)
+        self.assertFalse('_pending' in elf.__dict__)
+
+    def test_fixed_size_elements(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        elf = ElfFile(path_elf)
+        symtab = elf.get_section_by_name('.symtab')
+
+        self.assertEqual(symtab.element_size(), 16)  # ELF32
+        self.assertEqual(symtab.size(), len(symtab) * 16)
+
+        symtab.invalidate_size()
+        with mock.patch.object(elf_fields.SymbolTableEntry, 'size', side_effect=AssertionError):
+            self.assertEqual(symtab.size(), len(symtab) * 16)  # without looking at the elements
+
+        element = symtab.unpack_element_at(Stream(path_elf), 42)
+        self.assertEqual(element.offset, symtab.value[42].offset)
+        self.assertEqual(element.st_name.value, symtab.value[42].st_name.value)
+        self.assertEqual(element.st_value.value, symtab.value[42].st_value.value)
+
+        self.assertIsNone(fields.ArrayField(PNGChunk()).element_size())
+
+    def test_lazy_tables(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        eager = ElfFile(path_elf).get_section_by_name('.symtab')
+        elf = ElfFile(path_elf, lazy_tables=True)
+        symtab = elf.get_section_by_name('.symtab')
+
+        self.assertIsInstance(symtab.value, fields.LazyElements)
+        self.assertEqual(len(symtab.value.cache), 0)
+        self.assertEqual(len(symtab), len(eager))
+        self.assertEqual(symtab.size(), eager.size())
+
+        self.assertEqual(symtab[42].st_value.value, eager[42].st_value.value)
+        self.assertIs(symtab[42], symtab[42])
+        self.assertEqual(symtab[-1].st_name.value, eager[-1].st_name.value)
+        self.assertEqual(len(symtab.value.cache), 2)
+
+        symtab.value.cache_size = 8
+        self.assertEqual([_.st_name.value for _ in symtab], [_.st_name.value for _ in eager])
+        self.assertEqual(len(symtab.value.cache), 8)
+
+        # the lazy elements are packed like the others
+        self.assertEqual(elf.pack(), ElfFile(path_elf).pack())
+
+    def test_repack(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        with tempfile.TemporaryDirectory() as root:
+            path_output = os.path.join(root, 'main')
+            shutil.copy(path_elf, path_output)
+
+            elf = ElfFile(Stream(path_output, flags='r+'))
+            self.assertEqual(elf.repack(), [])  # the values written while unpacking don't count
+
+            entry = elf.header.e_entry
+            symbol = elf.get_section_by_name('.symtab')[3]
+
+            elf.header.e_entry = 0x12345678  # passing from the descriptor
+            symbol.st_value.value = 0xcafe
+
+            self.assertEqual(elf.repack(), [(entry.offset, 4), (symbol.st_value.offset, 4)])
+            elf.stream.obj.flush()
+
+            with open(path_elf, 'rb') as f:
+                original = f.read()
+            with open(path_output, 'rb') as f:
+                patched = f.read()
+
+            self.assertEqual(len(patched), len(original))
+            self.assertEqual(sum([a != b for a, b in zip(original, patched)]), 6)
+
+            elf = ElfFile(path_output)
+            self.assertEqual(elf.header.e_entry.value, 0x12345678)
+            self.assertEqual(elf.get_section_by_name('.symtab')[3].st_value.value, 0xcafe)
+
+    def test_resized_section_size(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        elf = ElfFile(path_elf)
+        size = elf.size()
+
+        # the size cached by the ElfFile is forgotten when a section changes
+        text = elf.get_section_by_name('.text')
+        text.value = bytes(text.value) + b'\x90' * 100
+
+        self.assertEqual(elf.size(), size + 100)
+
+    def test_pack_layout(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        elf = ElfFile(path_elf)
+
+        with open(path_elf, 'rb') as f:
+            original = f.read()
+
+        shoff, phoff = elf.header.e_shoff.value, elf.header.e_phoff.value
+        data = elf.pack()
+        self.assertEqual(data, original)
+
+        # the headers and the sections stay where they were found
+        self.assertEqual(len(data), len(original))
+        self.assertEqual((elf.header.e_shoff.value, elf.header.e_phoff.value), (shoff, phoff))
+        self.assertEqual(data[shoff:], original[shoff:])
+        self.assertEqual(
+            [_.sh_offset.value for _ in elf.sections_header],
+            [_.sh_offset.value for _ in ElfFile(path_elf).sections_header],
+        )
+
+        # and so they can't change size
+        comment = elf.get_section_by_name('.comment')
+        comment.value = bytes(comment.value) + b'\x00'
+
+        with self.assertRaises(ValueError):
+            elf.pack()
+
+    def test_repack_section(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        with tempfile.TemporaryDirectory() as root:
+            path_output = os.path.join(root, 'main')
+            shutil.copy(path_elf, path_output)
+
+            elf = ElfFile(Stream(path_output, flags='r+'))
+            text = elf.get_section_by_name('.text')
+            text.value = b'\x90' * len(text)
+
+            self.assertEqual(elf.repack(), [(text.offset, len(text))])
+            elf.stream.obj.flush()
+
+            self.assertEqual(bytes(ElfFile(path_output).get_section_by_name('.text').value), b'\x90' * len(text))
+
+    def test_repack_resize(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        with tempfile.TemporaryDirectory() as root:
+            path_output = os.path.join(root, 'main')
+            shutil.copy(path_elf, path_output)
+
+            with open(path_elf, 'rb') as f:
+                original = f.read()
+
+            elf = ElfFile(Stream(path_output, flags='r+'))
+            comment = elf.get_section_by_name('.comment')
+            comment.value = bytes(comment.value) + b'\x00'
+
+            # the other sections would be left where the headers don't say
+            with self.assertRaises(ValueError):
+                elf.repack()
+
+            elf.stream.obj.flush()
+
+            with open(path_output, 'rb') as f:
+                self.assertEqual(f.read(), original)
+
+    def test_pack_to(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        elf = ElfFile(path_elf)
+        data = elf.pack()
+
+        with tempfile.TemporaryDirectory() as root:
+            path_output = os.path.join(root, 'main')
+
+            self.assertEqual(elf.pack_to(path_output), len(data))
+
+            with open(path_output, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            # nothing is kept in memory when packing into a file
+            self.assertIsNone(elf.pack(stream=Stream(path_output, flags='w')))
+
+        output = io.BytesIO()
+        elf.pack_to(output)
+        self.assertEqual(output.getvalue(), data)
+
+    def test_pack_segments(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        elf = ElfFile(path_elf)
+
+        with open(path_elf, 'rb') as f:
+            original = f.read()
+
+        # each segment is written at the offset of its header
+        data = elf.segments.pack()
+
+        for header, segment in zip(elf.segments_header, elf.segments.value):
+            start, end = header.p_offset.value, header.p_offset.value + segment.size()
+            self.assertEqual(data[start:end], original[start:end])
+
+        self.assertEqual(elf.dynamic.offset, elf.segments_header[4].p_offset.value)
+
+    def test_block_cache(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+        elf = ElfFile(Stream(path_elf, cache_size=64 * 1024))
+
+        self.assertIsInstance(elf.stream.obj, BlockCacheIO)
+        self.assertEqual(elf.section_names, ElfFile(path_elf).section_names)
+        self.assertEqual(elf.stream.obj.raw_reads, 2)  # the file is smaller than a block, the second read finds the end
+
+    def test_mmap(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        elf = ElfFile(Stream(path_elf, mmap=True))
+        eager = ElfFile(path_elf)
+
+        self.assertEqual(elf.section_names, eager.section_names)
+
+        text = elf.sections.value[elf.section_names.index('.text')]
+
+        self.assertIsInstance(text.value, memoryview)
+        self.assertEqual(text.value, eager.sections.value[eager.section_names.index('.text')].value)
+
+    def test_probe(self):
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        elf = ElfFile.probe(path_elf, fields=['header.e_shnum'])
+
+        self.assertEqual(elf.__dict__['header'].__dict__['_pending'].pending, set(['e_shstrndx']))
+        self.assertEqual(elf.__dict__['header'].__dict__['e_shnum'].value, 30)
+        self.assertEqual(elf.__dict__['sections_header'].value, [])
+
+        # the rest is unpacked when needed
+        self.assertEqual(elf.section_names, ElfFile(path_elf).section_names)
+        self.assertFalse('_pending' in elf.header.__dict__)
+
+    def test_positional_stream(self):
+        '''more threads unpack from the same stream at the same time'''
+        path_elf = os.path.join(os.path.dirname(__file__), 'main')
+
+        stream = PositionalStream(path_elf)
+        eager = ElfFile(path_elf)
+
+        def parse(_):
+            stream.seek(0)  # the threads of the pool are reused
+            return ElfFile(stream)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            elfs = list(executor.map(parse, range(8)))
+
+        for elf in elfs:
+            self.assertEqual(elf.section_names, eager.section_names)
+
     def test_not_elf(self):
         '''if we try to parse a stream is not an ELF what happens?'''
         data_empty = b''
@@ -650,6 +1265,96 @@ class STK500Tests(unittest.TestCase):
         self.assertEqual(packet.message_size.value, 5)
         self.assertEqual(packet.message_body.value, b'\x01\x02\x03\x04\x05')
 
+    def test_lazy(self):
+        '''the offset of a field is found unpacking the previous ones'''
+        packet = STK500Packet(b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff', lazy=True)
+
+        self.assertEqual(packet.checksum.value, 0xff)
+        self.assertEqual(packet.checksum.offset, 10)
+        self.assertEqual(packet.message_body.value, b'\x01\x02\x03\x04\x05')
+
+    def test_unpack_until(self):
+        packet = STK500Packet()
+        packet.unpack_until(Stream(b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff'), 'message_size')
+
+        self.assertEqual(packet.__dict__['_pending'].pending, set(['token', 'message_body', 'checksum']))
+        self.assertEqual(packet.message_size.value, 5)
+        self.assertEqual(packet.checksum.value, 0xff)
+
+    def test_iter_unpack(self):
+        capture = b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff' + b'\x1b\x05\x00\x01\x0e\xaa\x00'
+
+        packets = STK500Packet.iter_unpack(Stream(capture))
+
+        first = next(packets)
+        self.assertEqual(first.sequence_number.value, 4)
+        self.assertEqual(first.message_body.value, b'\x01\x02\x03\x04\x05')
+
+        second = next(packets)
+        self.assertEqual(second.offset, 11)
+        self.assertEqual(second.message_body.value, b'\xaa')
+
+        self.assertEqual(list(packets), [])
+        self.assertEqual([_.sequence_number.value for _ in STK500Packet.iter_unpack(capture, count=1)], [4])
+
+    def test_pack_into(self):
+        stk500_packet = b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff'
+        packet = STK500Packet(stk500_packet)
+
+        self.assertEqual(packet.pack(), stk500_packet)
+
+        buffer = bytearray(b'\xaa' * 16)
+        self.assertEqual(packet.pack_into(buffer, offset=2), len(stk500_packet))
+        self.assertEqual(buffer, b'\xaa\xaa' + stk500_packet + b'\xaa' * 3)
+        # the values were packed in place, the raw data is built on request
+        self.assertEqual(packet.message_size.raw, b'\x00\x05')
+
+        with self.assertRaises(ValueError):
+            packet.pack_into(memoryview(bytearray(4)))
+
+        # packing into a stream returns nothing, the fields don't copy the shared buffer
+        buffer = bytearray(len(stk500_packet))
+        self.assertIsNone(packet.pack(stream=Stream(BufferIO(buffer))))
+        self.assertIsNone(packet.message_body.pack(stream=Stream(BufferIO(buffer))))
+        self.assertEqual(packet.message_body.pack(), b'\x01\x02\x03\x04\x05')
+
+    def test_repack(self):
+        capture = b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff' + b'\x1b\x05\x00\x01\x0e\xaa\x00'
+        stream = Stream(capture)
+        first, second = STK500Packet.iter_unpack(stream)
+
+        # the last one can change size, the stream is truncated after it
+        second.message_body.value = b'\xbb\xcc'
+        self.assertEqual(second.repack(), [(11, 8)])
+        self.assertEqual(stream.getvalue(), capture[:11] + b'\x1b\x05\x00\x02\x0e\xbb\xcc\x00')
+
+        # the first one would overwrite the second one
+        first.message_body.value = b'\x01'
+        with self.assertRaises(ValueError):
+            first.repack()
+
+    def test_repack_after_pack(self):
+        capture = b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff' + b'\x1b\x05\x00\x01\x0e\xaa\x00'
+        stream = Stream(capture)
+        first, second = STK500Packet.iter_unpack(stream)
+
+        # pack() lays the packet out from zero, repack() writes where it was found
+        self.assertEqual(second.pack(), capture[11:])
+        second.message_body.value = b'\xbb'
+        self.assertEqual(second.repack(), [(13, 2), (16, 1)])
+        self.assertEqual(stream.getvalue(), capture[:11] + b'\x1b\x05\x00\x01\x0e\xbb\x00')
+
+        second.pack()
+        second.message_body.value = b'\xbb\xcc'
+        self.assertEqual(second.repack(), [(11, 8)])
+        self.assertEqual(stream.getvalue(), capture[:11] + b'\x1b\x05\x00\x02\x0e\xbb\xcc\x00')
+
+        # and again after the whole packet was written
+        second.pack()
+        second.message_body.value = b'\xdd\xcc'
+        self.assertEqual(second.repack(), [(13, 2), (16, 2)])
+        self.assertEqual(stream.getvalue(), capture[:11] + b'\x1b\x05\x00\x02\x0e\xdd\xcc\x00')
+
     def test_cmd_sign_on(self):
         cmd_sign_on_message_response = b'\x01\x00\x08\x41\x56\x52\x49\x53\x50\x5f\x32'
 
@@ -661,6 +1366,83 @@ class STK500Tests(unittest.TestCase):
         self.assertEqual(message.signature.value, b"AVRISP_2")
 
 
+class BenchmarkTests(unittest.TestCase):
+
+    def test_run(self):
+        cases = [Case('stk500', STK500Packet, label, data) for label, data in stk500_inputs(sizes=(16,))]
+        results = list(run_benchmarks(cases, repeat=1))
+
+        self.assertEqual([_.operation for _ in results], ['unpack', 'pack', 'roundtrip'])
+
+        for result in results:
+            self.assertIsNone(result.error)
+            self.assertEqual(result.size, 22)
+            self.assertGreater(result.throughput, 0)
+            self.assertGreater(result.peak, 0)
+
+    def test_generators(self):
+        data = generate_elf(n_symbols=20, n_sections=3)
+        self.assertEqual(data, generate_elf(n_symbols=20, n_sections=3))
+
+        elf = ElfFile(Stream(data))
+        self.assertEqual(elf.section_names, ['', '.shstrtab', '.strtab', '.symtab', '.text.0', '.text.1', '.text.2'])
+        self.assertEqual(len(elf.get_section_by_name('.symtab').value), 21)
+        self.assertEqual(elf.pack(), data)
+
+        data = generate_png(width=16, height=16, idat_size=100)
+        png = PNGFile(Stream(data))
+        self.assertEqual([_.type.value for _ in png.chunks.value][:3], [b'IHDR', b'IDAT', b'IDAT'])
+        self.assertEqual(png.pack(), data)
+
+        archive = zipfile.ZipFile(io.BytesIO(generate_zip(n_members=10)))
+        self.assertEqual(len(archive.namelist()), 10)
+        self.assertIsNone(archive.testzip())
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def test_profile(self):
+        data = b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff'
+
+        with profile() as stats:
+            packet = STK500Packet(data)
+            packet.pack()
+
+        self.assertEqual(profiling.hooks, [])
+
+        body = stats.stats[('STK500Packet.message_body', 'StringField')]
+        self.assertEqual(body.calls, 2)  # unpack and pack
+        self.assertEqual(body.bytes_read, 5)
+        self.assertGreater(body.unpack_time, 0)
+        self.assertGreater(body.pack_time, 0)
+
+        self.assertEqual(sum([_.bytes_read for _ in stats.stats.values()]), len(data))
+        self.assertIn('STK500Packet.checksum', stats.report())
+
+        # nothing is counted outside the block
+        STK500Packet(data)
+        self.assertEqual(body.calls, 2)
+
+    def test_profile_restores_stats(self):
+        data = b'\x1b\x04\x00\x05\x0e\x01\x02\x03\x04\x05\xff'
+        stream = Stream(data)
+
+        with profile():
+            STK500Packet(stream)
+
+        # the counters created for the profile don't survive it
+        self.assertIsNone(stream.stats)
+
+        counters = StreamStats()
+        stream = Stream(data, stats=counters)
+
+        with profile():
+            STK500Packet(stream)
+
+        self.assertIs(stream.stats, counters)
+        self.assertEqual(counters.bytes_read, len(data))
+
+
 class PNGTests(unittest.TestCase):
 
     def test_header(self):
@@ -679,6 +1461,44 @@ class PNGTests(unittest.TestCase):
         for idx, chunk in enumerate(png.chunks.value):
             print(idx, chunk, chunk.isCritical(), chunk.crc.calculate())
 
+    def test_repack(self):
+        path_png = os.path.join(os.path.dirname(__file__), 'red.png')
+        with open(path_png, 'rb') as f:
+            stream = Stream(f.read())
+
+        png = PNGFile(stream)
+        idat = [_ for _ in png.chunks if _.type.value == b'IDAT'][0]
+        idat.Data.value = b'\x00' * idat.length.value
+
+        # the length is written via the dependency, the CRC is computed from the data
+        self.assertEqual(png.repack(), [(idat.length.offset, 4), (idat.Data.offset, 11), (idat.crc.offset, 4)])
+
+        patched = PNGFile(stream.getvalue())
+        idat = [_ for _ in patched.chunks if _.type.value == b'IDAT'][0]
+        self.assertEqual(idat.Data.value, b'\x00' * 11)
+        self.assertEqual(idat.crc.value, idat.crc.calculate())
+
+        # with a different size everything is packed again
+        idat.Data.value = b'\x00'
+        data = patched.pack()
+        self.assertEqual(patched.repack(), [(0, len(data))])
+        self.assertEqual(patched.stream.getvalue(), data)
+
+    def test_iter_unpack(self):
+        path_png = os.path.join(os.path.dirname(__file__), 'red.png')
+        png = PNGFile(path_png)
+
+        stream = Stream(path_png)
+        stream.seek(png.header.size())
+
+        empty = PNGFile()
+        types = [_.type.value for _ in empty.chunks.iter_unpack(stream)]
+
+        self.assertEqual(types, [_.type.value for _ in png.chunks.value])
+        self.assertEqual(types[-1], b'IEND')
+        # the elements are not kept by the array
+        self.assertEqual(len(empty.chunks), 0)
+
 
 class ZIPTests(unittest.TestCase):
 
@@ -688,3 +1508,159 @@ class ZIPTests(unittest.TestCase):
         zp = ZIPLocalFileHeader(path_minimal)
 
         self.assertEqual(zp.filename.value, b"a/b")
+
+
+class ScannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+        base = os.path.dirname(__file__)
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+
+        shutil.copy(os.path.join(base, 'main'), os.path.join(self.root, 'main'))
+        shutil.copy(os.path.join(base, 'main'), os.path.join(self.root, 'a', 'b', 'main'))
+        shutil.copy(os.path.join(base, 'red.png'), os.path.join(self.root, 'a', 'red.png'))
+
+        self.query = Query('abstruct.executables.elf', 'ElfFile', 'obj.header.e_machine.value == ns.enum.ElfMachine.EM_386')
+
+    def test_scan(self):
+        expected = sorted([
+            os.path.join(self.root, 'main'),
+            os.path.join(self.root, 'a', 'b', 'main'),
+        ])
+
+        for workers in [0, 2]:
+            scanner = Scanner(self.query, workers=workers, batch_size=1, queue_size=1)
+            self.assertEqual(sorted(scanner.scan([self.root])), expected)
+
+    def test_scan_limits(self):
+        scanner = Scanner(self.query, workers=0, max_depth=2)
+        self.assertEqual(list(scanner.scan([self.root])), [os.path.join(self.root, 'main')])
+
+        scanner = Scanner(self.query, workers=2, batch_size=1, max_results=1)
+        self.assertEqual(len(list(scanner.scan([self.root]))), 1)
+
+    def test_condition_fields(self):
+        self.assertEqual(
+            condition_paths('obj.header.e_machine.value == ns.enum.ElfMachine.EM_386 and len(obj.sections_header) > 1'),
+            [('header', 'e_machine', 'value'), ('sections_header',)],
+        )
+        self.assertIsNone(condition_paths('getattr(obj, "header")'))
+
+        self.assertEqual(self.query.fields, ['header.e_machine.value'])
+        self.assertIsNone(Query('abstruct.executables.elf', 'ElfFile', '".text" in obj.section_names').fields)
+
+        obj = self.query.parse(os.path.join(self.root, 'main'))
+
+        self.assertEqual(obj.__dict__['sections'].value, None)
+        self.assertIn('e_entry', obj.__dict__['header'].__dict__['_pending'])
+        self.assertTrue(self.query.evaluate(obj))
+
+    def test_index(self):
+        path_index = os.path.join(tempfile.mkdtemp(), 'index.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path_index))
+        path_elf = os.path.join(self.root, 'main')
+
+        scanner = Scanner(self.query, workers=0, index=path_index)
+        expected = sorted(scanner.scan([self.root]))
+
+        index = ScanIndex(path_index)
+        record = index.get(path_elf, self.query.format)
+
+        self.assertEqual(record.get('header.e_machine.value'), ElfMachine.EM_386)
+        self.assertIsNone(index.get(os.path.join(self.root, 'a', 'red.png'), self.query.format))
+
+        with self.assertRaises(MissingPath):
+            ReplayProxy(record).header.e_type.value
+
+        # now the files are not parsed anymore
+        with mock.patch.object(ElfFile, 'unpack', side_effect=AssertionError):
+            self.assertEqual(sorted(Scanner(self.query, workers=0, index=path_index).scan([self.root])), expected)
+
+        self.assertEqual(sorted(Scanner(self.query, workers=2, index=path_index).scan([self.root])), expected)
+
+        # a different condition needs other values
+        query = Query('abstruct.executables.elf', 'ElfFile', '".text" in obj.section_names')
+        self.assertEqual(sorted(Scanner(query, workers=0, index=path_index).scan([self.root])), expected)
+        self.assertIn('.text', index.get(path_elf, self.query.format).get('section_names'))
+
+    def test_index_operations(self):
+        '''the operations on a field that are not recorded are not indexed'''
+        path_index = os.path.join(tempfile.mkdtemp(), 'index.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path_index))
+        path_elf = os.path.join(self.root, 'main')
+        index = ScanIndex(path_index)
+
+        for condition in ['str(obj.header.e_type) == "0x0003"', 'obj.header.e_machine == obj.header.e_machine']:
+            query = Query('abstruct.executables.elf', 'ElfFile', condition)
+
+            for _ in range(2):
+                self.assertEqual(list(Scanner(query, workers=0, index=path_index).scan([path_elf])), [path_elf])
+
+            with self.assertRaises(KeyError):
+                index.get(path_elf, query.format)
+
+        # the values used by the operations are still recorded
+        query = Query('abstruct.executables.elf', 'ElfFile', '3 < obj.header.e_shnum.value + 0')
+        self.assertEqual(list(Scanner(query, workers=0, index=path_index).scan([path_elf])), [path_elf])
+        self.assertEqual(index.get(path_elf, query.format).get('header.e_shnum.value'), 30)
+
+        with self.assertRaises(MissingPath):
+            str(ReplayProxy(index.get(path_elf, query.format)).header)
+
+    def test_index_encoding(self):
+        record = Record()
+        record.values = {
+            ('header', 'e_machine', 'value'): ElfMachine.EM_386,
+            ('section_names',): ['', '.text'],
+            ('sections', ('[]', 1), 'value'): b'\x00\xff',
+            ('sections', '__len__'): 30,
+            ('flag',): (True, None, 1.5),
+        }
+        record.nodes = set([(), ('header',), ('sections', ('[]', 1))])
+
+        decoded = Record.loads(record.dumps())
+        self.assertEqual(decoded.values, record.values)
+        self.assertIs(decoded.values[('header', 'e_machine', 'value')], ElfMachine.EM_386)
+        self.assertEqual(decoded.nodes, record.nodes)
+
+        with self.assertRaises(ValueError):
+            Record.loads('{"values": [[["a"], {"enum": ["os", "path", 1]}]], "nodes": []}')
+
+        # the database is only data, what is not a record is parsed again
+        path_index = os.path.join(tempfile.mkdtemp(), 'index.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path_index))
+        path_elf = os.path.join(self.root, 'main')
+        index = ScanIndex(path_index)
+        size, mtime = index.stat(path_elf)
+
+        index.connection.execute(
+            'INSERT INTO files (path, format, size, mtime, record) VALUES (?, ?, ?, ?, ?)',
+            (path_elf, self.query.format, size, mtime, b'\x80\x04cos\nsystem\n.'),
+        )
+
+        with self.assertRaises(KeyError):
+            index.get(path_elf, self.query.format)
+
+    def test_index_io_error(self):
+        path_index = os.path.join(tempfile.mkdtemp(), 'index.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path_index))
+        path_elf = os.path.join(self.root, 'main')
+        index = ScanIndex(path_index)
+
+        # a file that cannot be read is not recorded as not of the format
+        with mock.patch.object(ElfFile, 'unpack', side_effect=PermissionError):
+            self.assertEqual(self.query.match_indexed(path_elf, index), (False, None))
+
+        with mock.patch('builtins.open', side_effect=PermissionError):
+            self.assertEqual(self.query.match_indexed(path_elf, index), (False, None))
+
+        matched, entry = self.query.match_indexed(path_elf, index)
+        self.assertTrue(matched)
+        self.assertIsNotNone(entry[2])
+
+        # while one that is not of the format is
+        path_png = os.path.join(self.root, 'a', 'red.png')
+        self.assertEqual(self.query.match_indexed(path_png, index), (False, (path_png, self.query.format, None, index.stat(path_png))))
@@ -5,25 +5,22 @@ Reimplementation of the find(1) utilities but for file format.
 TODO: implement common option such as
        - do not follow symlink
 '''
+import argparse
 import os
-import sys
-import importlib
 import logging
-from pathlib import Path
-from enum import Enum
-from abstruct.executables import elf
-from abstruct.enum import Compliant
-from abstruct.exceptions import MagicException, ChunkUnpackException
+
+from abstruct.scanner import Query, Scanner
 
 
 logging.basicConfig(level=logging.DEBUG if 'DEBUG' in os.environ else logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def usage(progname):
-    print(f'''usage: {progname} [namespace] [object] [condition] [paths...]
-
-The condition parameter can use the namespace by the variable "ns" and the parsed
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='find the files of a given format satisfying a condition',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='''The condition parameter can use the namespace by the variable "ns" and the parsed
 object by the variable "obj". The path must be a directory.
 
 For example
@@ -31,47 +28,36 @@ For example
  $ find.py abstruct.executables.elf ElfFile obj.header.e_machine.value==ns.enum.ElfMachine.EM_386 /
 
 will find all the ELF executables that target the i386 architecture.''')
-    sys.exit(1)
-
 
-def parse_file(cls, path):
-    try:
-        victim = cls(path, compliant=Compliant.MAGIC)
-    except (MagicException, FileNotFoundError, PermissionError, ChunkUnpackException, OSError):
-        return None
-    except Exception as e:
-        logger.error(f'failed to handle file at path \'{path}\'', exc_info=True)
-        return None
+    parser.add_argument('namespace', help='the module containing the format')
+    parser.add_argument('object', help='the name of the Chunk describing the format')
+    parser.add_argument('condition', help='python expression the parsed object must satisfy')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of processes parsing the files, 0 to do all in this process (default: one per CPU)')
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help='maximum number of batches of files waiting to be parsed')
+    parser.add_argument('--max-results', type=int, default=None, help='stop after this many matches')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='descend at most this many levels below the paths')
+    parser.add_argument('--index', default=None,
+                        help='sqlite database where to keep the values used by the condition, unchanged files are not parsed again')
 
-    return victim
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 5:
-        usage(sys.argv[0])
-
-    ns = sys.argv[1]
-    obj_name = sys.argv[2]
-
-    ns = importlib.import_module(ns)
-
-    conditions = sys.argv[3]
-    paths = sys.argv[4:]
-
-    cls = getattr(ns, obj_name)
-
-    for basepath in paths:
-        for path in Path(basepath).glob('**/*'):
-            if not path.is_file():
-                continue
-            path = str(path.resolve())  # FIXME: in this way resolve symlinks and could be a problem
-            logger.debug(path)
-
-            obj = parse_file(cls, path)
-
-            if not obj:
-                continue
-
-            code = compile(conditions, 'string', 'exec')
-            if eval(code):
-                print(path)
+    args = parse_args()
+
+    query = Query(args.namespace, args.object, args.condition)
+    scanner = Scanner(
+        query,
+        workers=args.jobs,
+        queue_size=args.queue_size,
+        max_results=args.max_results,
+        max_depth=args.max_depth,
+        index=args.index,
+    )
+
+    for path in scanner.scan(args.paths):
+        print(path, flush=True)
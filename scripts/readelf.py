@@ -4,6 +4,7 @@ import os
 import logging
 
 from abstruct.executables.elf import ElfFile
+from abstruct.streams import Stream, StreamStats
 from abstruct.executables.elf.enum import (
     ElfSegmentType,
     ElfDynamicTagType,
@@ -96,7 +97,10 @@ if __name__ == '__main__':
 
     path = sys.argv[1]
 
-    elf = ElfFile(path)
+    # with TRACE in the environment the accesses to the file are dumped at the end
+    stats = StreamStats(trace=True) if 'TRACE' in os.environ else None
+
+    elf = ElfFile(Stream(path, stats=stats))
 
     dump_header(elf.header)
 
@@ -123,3 +127,6 @@ if __name__ == '__main__':
             rels = elf.dynamic.get(ElfDynamicTagType.DT_RELA)
             if rels:
                 dump_reloc(rels, elf.dynamic)
+
+    if stats is not None:
+        print(stats.dump(), file=sys.stderr)